@@ -1,11 +1,31 @@
 import os
+from functools import partial
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   jsonify, url_for)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from models import db, connect_db, User, Message, Follows, Likes
+from passwords import hasher, PasswordHasherBusy
+import assets
+import counters
+import dbpool
+import fragments
+import httpcache
+import images
+import instrumentation
+import jobs
+import migrations
+import pagination
+import ratelimit
+import replicas
+import search
+import streaming
+import timeline
+import usercache
 
 CURR_USER_KEY = "curr_user"
 
@@ -16,13 +36,105 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# Optional read replicas (see replicas.py): comma separated database URLs.
+# After a write, a visitor's reads stay on the primary for a few seconds.
+app.config['REPLICA_DATABASE_URIS'] = [
+    url for url in os.environ.get('REPLICA_DATABASE_URLS', '').split(',') if url]
+app.config['REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+# Connection pool (see dbpool.py). DATABASE_PGBOUNCER=1 leaves pooling to
+# pgbouncer in transaction mode instead.
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+app.config['DATABASE_POOL_TIMEOUT'] = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+app.config['DATABASE_POOL_RECYCLE'] = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+app.config['DATABASE_POOL_PRE_PING'] = os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1'
+app.config['DATABASE_PGBOUNCER'] = os.environ.get('DATABASE_PGBOUNCER') == '1'
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Precomputed home timelines (see timeline.py); off unless asked for.
+app.config['TIMELINE_FANOUT'] = os.environ.get('TIMELINE_FANOUT') == '1'
+app.config['TIMELINE_LENGTH'] = int(os.environ.get('TIMELINE_LENGTH', 800))
+app.config['TIMELINE_PULL_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_PULL_THRESHOLD', 10000))
+
+# bcrypt work factor and the size of the pool that runs it (see passwords.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', 4))
+app.config['BCRYPT_MAX_PENDING'] = int(os.environ.get('BCRYPT_MAX_PENDING', 32))
+
+# Logged-in user cache (see usercache.py); a TTL of 0 turns it off.
+# Set CACHE_REDIS_URL to share caches between worker processes.
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+
+# How long browsers and proxies may reuse pages shown to anonymous visitors
+# (see httpcache.py)
+app.config['HTTP_CACHE_MAX_AGE'] = int(os.environ.get('HTTP_CACHE_MAX_AGE', 60))
+
+# Fingerprinted copies of static/, made by `flask assets-build` (see assets.py)
+if os.environ.get('ASSETS_DIR'):
+    app.config['ASSETS_DIR'] = os.environ['ASSETS_DIR']
+
+# Local copies of users' images, resized (see images.py). The cache
+# directory is kept under IMAGE_CACHE_MAX_BYTES.
+if os.environ.get('IMAGE_CACHE_DIR'):
+    app.config['IMAGE_CACHE_DIR'] = os.environ['IMAGE_CACHE_DIR']
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Background jobs (see jobs.py) are run by `flask jobs-work`; set this to
+# run a worker thread inside the web process instead (for development).
+app.config['JOBS_WORKER_THREAD'] = os.environ.get('JOBS_WORKER_THREAD') == '1'
+
+# Token-bucket limits on login, signup and posting, per IP and per user
+# (see ratelimit.py), written like '10/minute'.
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+app.config['RATELIMITS'] = {
+    name: os.environ.get(f'RATELIMIT_{name.upper()}', rate)
+    for name, rate in ratelimit.DEFAULT_LIMITS.items()
+}
+
+# Per-request SQL/render metrics, served from /metrics (see instrumentation.py)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['METRICS_ALLOW_LOCAL'] = os.environ.get('METRICS_ALLOW_LOCAL') == '1'
 toolbar = DebugToolbarExtension(app)
 
+replicas.init_app(app)
 connect_db(app)
+instrumentation.init_app(app)
+ratelimit.init_app(app, user_key=CURR_USER_KEY)
+hasher.init_app(app)
+usercache.init_app(app)
+fragments.init_app(app)
+httpcache.init_app(app)
+assets.init_app(app)
+images.init_app(app)
+
+instrumentation.metrics.add_source('bcrypt', hasher.stats)
+instrumentation.metrics.add_source('pool', partial(dbpool.engine_stats, app))
+for bind in replicas.replica_keys(app):
+    instrumentation.metrics.add_source(f'pool_{bind}',
+                                       partial(dbpool.engine_stats, app, bind))
+if usercache.cache is not None:
+    instrumentation.metrics.add_source('user_cache', usercache.cache.stats)
+if fragments.cache is not None:
+    instrumentation.metrics.add_source('fragment_cache', fragments.cache.stats)
+instrumentation.metrics.add_source('jobs', jobs.stats)
+if ratelimit.buckets is not None:
+    instrumentation.metrics.add_source('ratelimit', ratelimit.buckets.stats)
+instrumentation.metrics.add_source('timeline', timeline.merge_stats.as_dict)
+
+if app.config['JOBS_WORKER_THREAD']:
+    jobs.start_worker_thread(app)
 
 
 ##############################################################################
@@ -34,7 +146,14 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        # Writes check the user still exists (see usercache.py)
+        g.user = usercache.load(session[CURR_USER_KEY],
+                                fresh=request.method not in replicas.READ_METHODS)
+
+        # An account being deleted is logged out everywhere
+        if g.user is not None and g.user.deleting:
+            do_logout()
+            g.user = None
 
     else:
         g.user = None
@@ -54,6 +173,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@ratelimit.limit('signup')
 def signup():
     """Handle user signup.
 
@@ -81,6 +201,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordHasherBusy:
+            flash("We're very busy right now. Please try again in a moment.", 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -90,16 +214,24 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@ratelimit.limit('login')
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordHasherBusy:
+            flash("We're very busy right now. Please try again in a moment.", 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # authenticate() may have upgraded the stored password hash
+            db.session.commit()
+            usercache.invalidate(user.id)
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -121,40 +253,74 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@replicas.read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    'page' to page through the results. Without 'q', users are listed
+    alphabetically a page at a time, continuing 'after' a username.
     """
 
-    search = request.args.get('q')
+    q = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if not q:
+        page = search.browse(after=request.args.get('after'))
+        next_args = dict(after=page.next_cursor)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = search.search(q, page=request.args.get('page', 1, type=int))
+        next_args = dict(q=q, page=page.next_cursor)
 
-    return render_template('users/index.html', users=users)
+    next_url = url_for('list_users', **next_args) if page.next_cursor else None
+
+    users = page.items
+    following_ids = g.user.following_ids(users) if g.user else set()
+
+    return render_template('users/index.html',
+                           users=users,
+                           following_ids=following_ids,
+                           next_url=next_url)
 
 
 @app.route('/users/<int:user_id>')
+@replicas.read_only
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
+    before, limit = pagination.page_args()
+
+    # The listed messages only change when one is posted (a new newest id)
+    # or deleted (a lower count), so those plus the user's own row say
+    # whether the page has changed. Personalized pages aren't validated,
+    # so they skip the query.
+    if not httpcache.is_personalized():
+        newest_id = (db.session.query(db.func.max(Message.id))
+                     .filter(Message.user_id == user_id)
+                     .scalar())
+        unchanged = httpcache.validate(user.id, user.version, user.messages_count,
+                                       user.following_count, user.followers_count,
+                                       user.likes_count, newest_id, before, limit)
+        if unchanged:
+            return unchanged
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = pagination.paginate(Message.query.filter(Message.user_id == user_id),
+                               Message.timestamp,
+                               Message.id,
+                               before=before,
+                               limit=limit)
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           limit=limit)
 
 
 @app.route('/users/<int:user_id>/following')
+@replicas.read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -163,10 +329,27 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    before, limit = pagination.id_page_args()
+
+    page = pagination.paginate_by_id(
+        User
+        .query
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id),
+        Follows.user_being_followed_id,
+        before=before,
+        limit=limit)
+
+    return render_template('users/following.html',
+                           user=user,
+                           users=page.items,
+                           following_ids=g.user.following_ids(page.items),
+                           next_cursor=page.next_cursor,
+                           limit=limit)
 
 
 @app.route('/users/<int:user_id>/followers')
+@replicas.read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -175,7 +358,23 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    before, limit = pagination.id_page_args()
+
+    page = pagination.paginate_by_id(
+        User
+        .query
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id),
+        Follows.user_following_id,
+        before=before,
+        limit=limit)
+
+    return render_template('users/followers.html',
+                           user=user,
+                           users=page.items,
+                           following_ids=g.user.following_ids(page.items),
+                           next_cursor=page.next_cursor,
+                           limit=limit)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -186,9 +385,21 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    counters.adjust(g.user.id, following_count=1)
+    counters.adjust(followed_user.id, followers_count=1)
+
+    if timeline.is_enabled():
+        db.session.flush()
+        timeline.backfill(g.user.id, followed_user.id)
+
     db.session.commit()
+    usercache.invalidate(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -203,7 +414,14 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    counters.adjust(g.user.id, following_count=-1)
+    counters.adjust(followed_user.id, followers_count=-1)
+
+    if timeline.is_enabled():
+        timeline.prune(g.user.id, followed_user.id)
+
     db.session.commit()
+    usercache.invalidate(g.user.id, followed_user.id)
     flash(f'Stopped following {followed_user.username}.')
 
     return redirect(f"/users/{g.user.id}/following")
@@ -224,11 +442,23 @@ def profile():
         user.email = form.email.data
         user.image_url = form.image_url.data
         user.header_image_url = form.header_image_url.data
+
+        try:
+            if form.image_file.data:
+                user.image_url = images.store_upload(form.image_file.data)
+            if form.header_image_file.data:
+                user.header_image_url = images.store_upload(form.header_image_file.data)
+        except images.ImageError as exc:
+            flash(f"Couldn't use that image: {exc}.", 'danger')
+            return render_template('users/edit.html', form=form)
+
         user.bio = form.bio.data
         user.location = form.location.data
+        user.version = User.version + 1
 
         db.session.add(user)
         db.session.commit()
+        usercache.invalidate(user.id)
         flash(f"Successfully updated {user.username}'s profile!", 'success')
         return redirect(f'/users/{user.id}')
     else: 
@@ -245,8 +475,14 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # A prolific user's messages, follows and likes can take a while to
+    # delete, so that happens in the background. Until then the account
+    # is marked so it can't be used.
+    g.user.deleting = True
+    jobs.enqueue('delete_user', user_id=g.user.id)
     db.session.commit()
+    usercache.invalidate(g.user.id)
+    flash("Your account is being deleted.", "success")
 
     return redirect("/signup")
 
@@ -258,19 +494,22 @@ def like_message(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    liked_msg = Message.query.get_or_404(msg_id)
+    Message.query.get_or_404(msg_id)
 
-    likes = g.user.likes
-    if liked_msg in likes:
-        g.user.likes = [l for l in likes if l != liked_msg]
-    else:
-        g.user.likes.append(liked_msg)
+    # Pages with JavaScript use /api/messages/<id>/like instead; this is
+    # the plain form fallback.
+    if g.user.unlike(msg_id):
+        counters.adjust(g.user.id, likes_count=-1)
+    elif g.user.like(msg_id):
+        counters.adjust(g.user.id, likes_count=1)
 
     db.session.commit()
+    usercache.invalidate(g.user.id)
     return redirect("/")
 
 
 @app.route('/users/<int:user_id>/likes')
+@replicas.read_only
 def show_likes(user_id):
     """Show details page for liked warbles"""
     if not g.user:
@@ -278,13 +517,31 @@ def show_likes(user_id):
         return redirect("/")
     
     user = User.query.get_or_404(user_id)
-
-    return render_template('users/likes.html', user=user)
+    before, limit = pagination.id_page_args()
+
+    # Newest warbles first, which the (user_id, message_id) unique index serves
+    page = pagination.paginate_by_id(
+        Message
+        .query
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id)
+        .options(db.joinedload(Message.user)),
+        Likes.message_id,
+        before=before,
+        limit=limit)
+
+    return render_template('users/likes.html',
+                           user=user,
+                           messages=page.items,
+                           liked_ids=g.user.liked_message_ids(page.items),
+                           next_cursor=page.next_cursor,
+                           limit=limit)
 
 ##############################################################################
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@ratelimit.limit('post')
 def messages_add():
     """Add a message:
 
@@ -300,7 +557,16 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        counters.adjust(g.user.id, messages_count=1)
+
+        if timeline.is_enabled():
+            db.session.flush()
+            timeline.post(msg)
+            if not timeline.is_pulled(g.user):
+                jobs.enqueue('fan_out', message_id=msg.id)
+
         db.session.commit()
+        usercache.invalidate(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -308,10 +574,19 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@replicas.read_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = (Message.query
+           .options(db.joinedload(Message.user))
+           .get_or_404(message_id))
+
+    # Messages never change, so only their author's profile can
+    unchanged = httpcache.validate(msg.id, msg.user_id, msg.user.version)
+    if unchanged:
+        return unchanged
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -324,55 +599,185 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    counters.forget_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    usercache.invalidate(msg.user_id)
     flash('Successfully deleted your warble.', 'success')
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# JSON API routes:
+
+@app.route('/api/users/autocomplete')
+@replicas.read_only
+def users_autocomplete():
+    """Type-ahead suggestions for usernames starting with 'q'."""
+
+    q = request.args.get('q', '').strip()
+    users = search.autocomplete(q) if q else []
+
+    return jsonify(users=[dict(id=user.id,
+                               username=user.username,
+                               image_url=user.image_url)
+                          for user in users])
+
+
+@app.route('/api/users/<int:user_id>/messages')
+@replicas.read_only
+def api_user_messages(user_id):
+    """Stream a user's messages as NDJSON, newest first.
+
+    Takes an optional 'before' cursor and 'limit'; with neither, this is
+    the user's whole history.
+    """
+
+    User.query.get_or_404(user_id)
+
+    return streaming.ndjson_response(streaming.messages_query(
+        Message.user_id == user_id,
+        before=pagination.cursor_arg(),
+        limit=streaming.limit_arg()))
+
+
+@app.route('/api/timeline')
+@replicas.read_only
+def api_timeline():
+    """Stream the logged-in user's home timeline as NDJSON, newest first.
+
+    This is every message by the user and those they follow, not just
+    what a precomputed timeline holds. Takes 'before' and 'limit' like
+    /api/users/<id>/messages.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    following = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == g.user.id))
+
+    return streaming.ndjson_response(streaming.messages_query(
+        (Message.user_id == g.user.id) | Message.user_id.in_(following),
+        before=pagination.cursor_arg(),
+        limit=streaming.limit_arg()))
+
+
+@app.route('/api/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def api_like_message(message_id):
+    """Like (PUT) or unlike (DELETE) a message as the logged-in user.
+
+    Both are idempotent. Responds with the new state and like count, e.g.
+    {"liked": true, "count": 3}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    message_exists = Message.query.filter(Message.id == message_id).exists()
+    if not db.session.query(message_exists).scalar():
+        return jsonify(error="Message not found."), 404
+
+    liked = request.method == 'PUT'
+    changed = g.user.like(message_id) if liked else g.user.unlike(message_id)
+    if changed:
+        counters.adjust(g.user.id, likes_count=1 if liked else -1)
+
+    count = Likes.query.filter(Likes.message_id == message_id).count()
+    db.session.commit()
+
+    if changed:
+        usercache.invalidate(g.user.id)
+
+    return jsonify(liked=liked, count=count)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/')
+@replicas.read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
 
     if g.user:
-        following = [f.id for f in g.user.following]
-        following.append(g.user.id)
+        before, limit = pagination.page_args()
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        if timeline.is_enabled():
+            page = timeline.read(g.user.id, before=before, limit=limit)
 
-        return render_template('home.html', messages=messages)
+        else:
+            page = timeline.pull(g.user.id, before=before, limit=limit)
+
+        return render_template('home.html',
+                               messages=page.items,
+                               liked_ids=g.user.liked_message_ids(page.items),
+                               next_cursor=page.next_cursor,
+                               limit=limit)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Command line maintenance tasks
+
+
+@app.cli.command('timeline-rebuild')
+def timeline_rebuild():
+    """Rebuild every user's precomputed home timeline from scratch.
+
+    Run this after switching TIMELINE_FANOUT on for an existing database.
+    """
+
+    for (user_id,) in db.session.query(User.id).order_by(User.id):
+        timeline.rebuild(user_id)
+        db.session.commit()
+
+
+@app.cli.command('counters-reconcile')
+@click.option('--queue', is_flag=True,
+              help="recompute in batches on the job queue instead of now")
+def counters_reconcile(queue):
+    """Recompute every user's message/follow/like counters from scratch."""
+
+    if queue:
+        jobs.enqueue('reconcile_counters')
+    else:
+        counters.reconcile()
+    db.session.commit()
+
+
+@app.cli.command('jobs-work')
+@click.option('--burst', is_flag=True, help="exit once the queue is empty")
+@click.option('--poll', default=1.0, help="seconds to wait when the queue is empty")
+def jobs_work(burst, poll):
+    """Run background jobs (see jobs.py)."""
+
+    jobs.work(poll_interval=poll, burst=burst)
+
+
+@app.cli.command('assets-build')
+def assets_build():
+    """Fingerprint and precompress the static files (see assets.py)."""
+
+    built = assets.build(app)
+    print(f"built {len(built)} assets into {app.config['ASSETS_DIR']}")
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Bring the database schema up to date (see migrations.py)."""
+
+    applied = migrations.upgrade()
+    if applied:
+        print(f"applied migrations {', '.join(map(str, applied))}")
+    else:
+        print("schema is up to date")
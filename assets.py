@@ -0,0 +1,178 @@
+"""Fingerprinted, precompressed static assets for Warbler.
+
+Flask's static view makes browsers revalidate every stylesheet and image
+on each page view. A build step instead copies everything under static/
+into ASSETS_DIR with a hash of its content in the name:
+
+    flask assets-build
+
+and writes a manifest mapping each file to its copy. Templates refer to
+static files through `asset_url('stylesheets/style.css')`, which uses
+the fingerprinted copy once there is one (and /static until then). The
+copies are served from /assets as immutable, so a browser never asks for
+one twice; a changed file gets a new name instead.
+
+Text files are also stored gzipped, and brotli-compressed when the
+`brotli` package is installed. Clients that accept either get the
+compressed copy as is, without compressing it on each request.
+Stylesheets' url(/static/...) references are rewritten to the
+fingerprinted copies too.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, send_from_directory, url_for
+
+URL_PREFIX = '/assets'
+MANIFEST = 'manifest.json'
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+# (Accept-Encoding token, file suffix), best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+CSS_URL = re.compile(r'''url\((['"]?)/static/([^'")]+)\1\)''')
+
+manifest = {}
+
+
+def init_app(app):
+    """Serve built assets and add the `asset_url` template helper to `app`."""
+
+    global manifest
+
+    app.config.setdefault('ASSETS_DIR', os.path.join(app.root_path, 'build', 'assets'))
+    manifest = load_manifest(app)
+
+    app.add_url_rule(f'{URL_PREFIX}/<path:filename>', 'asset', asset_view)
+    app.jinja_env.globals['asset_url'] = asset_url
+
+
+def load_manifest(app):
+    """The manifest of the last build, or {} if there hasn't been one."""
+
+    try:
+        with open(os.path.join(app.config['ASSETS_DIR'], MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(filename):
+    """URL for the static file `filename`, fingerprinted if it's been built."""
+
+    built = manifest.get(filename)
+    if built is None:
+        return url_for('static', filename=filename)
+
+    return url_for('asset', filename=built)
+
+
+##############################################################################
+# Build
+
+
+def _fingerprinted(filename, data):
+    """`filename` with a hash of `data` before its extension."""
+
+    stem, extension = os.path.splitext(filename)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+
+
+def _compressed(data):
+    """{suffix: compressed data} for each encoding that makes `data` smaller."""
+
+    # mtime=0 so the same input always builds the same file
+    versions = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        versions['.br'] = brotli.compress(data)
+
+    return {suffix: compressed for suffix, compressed in versions.items()
+            if len(compressed) < len(data)}
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+def build(app):
+    """Fingerprint and compress `app`'s static files; returns the manifest."""
+
+    global manifest
+
+    static = app.static_folder
+    out = app.config['ASSETS_DIR']
+
+    filenames = sorted(
+        os.path.relpath(os.path.join(root, name), static).replace(os.sep, '/')
+        for root, dirs, names in os.walk(static)
+        for name in names)
+
+    # Stylesheets last, so the files they refer to already have names
+    filenames.sort(key=lambda name: name.endswith('.css'))
+
+    built = {}
+    for filename in filenames:
+        with open(os.path.join(static, filename), 'rb') as file:
+            data = file.read()
+
+        if filename.endswith('.css'):
+            def rewrite(match):
+                target = built.get(match.group(2))
+                if target is None:
+                    return match.group(0)
+                return f'url({match.group(1)}{URL_PREFIX}/{target}{match.group(1)})'
+
+            data = CSS_URL.sub(rewrite, data.decode()).encode()
+
+        built[filename] = _fingerprinted(filename, data)
+        path = os.path.join(out, built[filename])
+        _write(path, data)
+
+        if os.path.splitext(filename)[1] in COMPRESSIBLE:
+            for suffix, compressed in _compressed(data).items():
+                _write(path + suffix, compressed)
+
+    _write(os.path.join(out, MANIFEST), json.dumps(built, indent=2).encode())
+
+    manifest = built
+    return built
+
+
+##############################################################################
+# Serving
+
+
+def asset_view(filename):
+    """Serve a built asset, precompressed if the client accepts it."""
+
+    directory = current_app.config['ASSETS_DIR']
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    for encoding, suffix in ENCODINGS:
+        if (request.accept_encodings[encoding]
+                and os.path.isfile(os.path.join(directory, filename + suffix))):
+            response = send_from_directory(directory, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype)
+
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
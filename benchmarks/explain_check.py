@@ -0,0 +1,185 @@
+"""Check that Warbler's hot queries are served by indexes.
+
+Seeds a database at benchmark scale (as loadtest.py does), requests each
+hot page, records every SELECT the page runs and EXPLAINs it. Exits
+non-zero if any plan sequentially scans a table big enough for that to
+matter:
+
+    python benchmarks/explain_check.py --users 10000 --messages 200000 \\
+        --follows 500000
+
+Tables with fewer than --min-rows rows are allowed to be scanned, since
+that is what Postgres should do with them (and nothing generates likes,
+so that table is empty after seeding). Username search needs the pg_trgm
+index; where the extension isn't available it is reported and skipped.
+
+Postgres only. The database named by --database-url is dropped and
+recreated unless --skip-seed is given.
+"""
+
+import argparse
+import os
+import sys
+
+from loadtest import ROOT, seed_database
+
+# (name, method, path, logged in?); {user} is the most followed user,
+# {viewer} the user following the most and {message} their newest message
+HOT_PAGES = [
+    ('homepage', 'GET', '/', True),
+    ('profile', 'GET', '/users/{user}', False),
+    ('profile (logged in)', 'GET', '/users/{user}', True),
+    ('following', 'GET', '/users/{viewer}/following', True),
+    ('followers', 'GET', '/users/{user}/followers', True),
+    ('likes', 'GET', '/users/{viewer}/likes', True),
+    ('message', 'GET', '/messages/{message}', False),
+    ('browse users', 'GET', '/users', False),
+    ('login', 'POST', '/login', False),
+    ('autocomplete', 'GET', '/api/users/autocomplete?q=jo', False),
+]
+
+LOGIN_FORM = dict(username='nobody', password='not-a-password')
+
+SEARCH_PAGES = [
+    ('search', 'GET', '/users?q=son', False),
+]
+
+
+def seq_scans(plan):
+    """Names of the relations that `plan` (EXPLAIN's JSON) scans sequentially."""
+
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found += seq_scans(child)
+    return found
+
+
+def capture(engine, statements):
+    """Record each SELECT `engine` runs as (statement, parameters)."""
+
+    from sqlalchemy import event
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    return record
+
+
+def check(args):
+    os.environ['DATABASE_URL'] = args.database_url
+    # every simulated client comes from the same address
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import event, func
+
+    from app import app, CURR_USER_KEY
+    from models import db, Follows, Message
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        if db.engine.dialect.name != 'postgresql':
+            sys.exit("explain_check needs a Postgres database")
+
+        if not args.skip_seed:
+            seed_database(args)
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+        rows = {table: count for table, count in db.session.execute(
+            "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")}
+        has_trigram = db.session.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_users_username_trgm'"
+        ).scalar()
+
+        followers = func.count(Follows.user_following_id)
+        user = (db.session.query(Follows.user_being_followed_id)
+                .group_by(Follows.user_being_followed_id)
+                .order_by(followers.desc())
+                .limit(1)
+                .scalar())
+        followed = func.count(Follows.user_being_followed_id)
+        viewer = (db.session.query(Follows.user_following_id)
+                  .group_by(Follows.user_following_id)
+                  .order_by(followed.desc())
+                  .limit(1)
+                  .scalar())
+        message = (db.session.query(func.max(Message.id))
+                   .filter(Message.user_id == user)
+                   .scalar())
+        db.session.remove()
+
+    pages = HOT_PAGES
+    if has_trigram:
+        pages = HOT_PAGES + SEARCH_PAGES
+    else:
+        print("no pg_trgm index on users.username; skipping "
+              f"{', '.join(name for name, *_ in SEARCH_PAGES)}")
+
+    failures = 0
+    for name, method, path, logged_in in pages:
+        path = path.format(user=user, viewer=viewer, message=message)
+        client = app.test_client()
+        if logged_in:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer
+
+        statements = []
+        listener = capture(db.engine, statements)
+        try:
+            client.open(path, method=method,
+                        data=LOGIN_FORM if method == 'POST' else None)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        raw_conn = db.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            for statement, parameters in statements:
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+                plan = cursor.fetchone()[0][0]['Plan']
+                scanned = [table for table in seq_scans(plan)
+                           if rows.get(table, 0) >= args.min_rows]
+                if scanned:
+                    failures += 1
+                    print(f"FAIL {name} ({method} {path}): sequential scan on "
+                          f"{', '.join(sorted(set(scanned)))}\n  "
+                          f"{' '.join(statement.split())}")
+        finally:
+            raw_conn.close()
+
+        print(f"{name}: {len(statements)} queries checked")
+
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fail if a hot Warbler query does a sequential scan.")
+    parser.add_argument('--database-url', default='postgresql:///warbler-bench')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--follows', type=int, default=500000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--min-rows', type=int, default=5000,
+                        help="ignore sequential scans of smaller tables")
+    args = parser.parse_args(argv)
+
+    failures = check(args)
+    if failures:
+        print(f"{failures} queries do sequential scans", file=sys.stderr)
+        return 1
+
+    print("no sequential scans on hot queries")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
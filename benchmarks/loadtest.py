@@ -0,0 +1,370 @@
+"""Route-level load test and latency benchmark for Warbler.
+
+Boots the app in-process against its own database, seeds it with a
+generated dataset of the requested size, then replays a weighted mix of
+scenarios from several concurrent virtual users:
+
+    python benchmarks/loadtest.py --users 10000 --messages 200000 \\
+        --follows 500000 --requests 5000 --concurrency 8 \\
+        --output results.json
+
+For each scenario it reports throughput, p50/p95/p99 latency and the
+number of SQL queries per request. Results are saved as JSON; pass an
+earlier results file as --compare to see what changed and, with
+--max-regression, to fail when p95 latency got worse.
+
+The database named by --database-url is dropped and recreated unless
+--skip-seed is given, so never point this at real data.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> weight; the weights are relative shares of all requests
+DEFAULT_MIX = dict(homepage=40, profile=20, search=10, like=15, follow=10, post=5)
+
+SEARCH_TERMS = ['an', 'jo', 'mar', 'ste', 'son', 'ly', 'er', 'ch']
+
+
+##############################################################################
+# Scenarios: each makes exactly one request as the virtual user `vu`
+
+
+def homepage(vu):
+    return vu.client.get('/')
+
+
+def profile(vu):
+    return vu.client.get(f'/users/{vu.random_user_id()}')
+
+
+def search(vu):
+    return vu.client.get(f'/users?q={vu.rng.choice(SEARCH_TERMS)}')
+
+
+def like(vu):
+    return vu.client.post(f'/users/add_like/{vu.random_message_id()}')
+
+
+def follow(vu):
+    """Follow someone new, or unfollow someone this user already follows."""
+
+    target = vu.random_user_id()
+    if target == vu.user_id:
+        target = target % vu.num_users + 1
+
+    if target in vu.following:
+        vu.following.discard(target)
+        return vu.client.post(f'/users/stop-following/{target}')
+
+    vu.following.add(target)
+    return vu.client.post(f'/users/follow/{target}')
+
+
+def post(vu):
+    return vu.client.post('/messages/new', data={'text': 'Benchmarking warble.'})
+
+
+SCENARIOS = dict(homepage=homepage, profile=profile, search=search,
+                 like=like, follow=follow, post=post)
+
+
+##############################################################################
+# Running
+
+
+class QueryCounter:
+    """Counts SQL statements executed by each thread."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self._local.count = self.count + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def reset(self):
+        self._local.count = 0
+
+
+class VirtualUser:
+    """One logged-in user with their own test client and random stream."""
+
+    def __init__(self, app, user_id, following, num_users, num_messages, seed):
+        from app import CURR_USER_KEY
+
+        self.client = app.test_client()
+        self.user_id = user_id
+        self.following = following
+        self.num_users = num_users
+        self.num_messages = num_messages
+        self.rng = random.Random(seed)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def random_user_id(self):
+        return self.rng.randint(1, self.num_users)
+
+    def random_message_id(self):
+        return self.rng.randint(1, self.num_messages)
+
+
+def seed_database(args):
+    """Generate a dataset of the requested size and load it."""
+
+    import seed
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                        '--users', str(args.users),
+                        '--messages', str(args.messages),
+                        '--follows', str(args.follows),
+                        '--seed', str(args.seed),
+                        '--now', '2020-01-01T00:00:00',
+                        '--out-dir', data_dir],
+                       check=True)
+        seed.seed(data_dir)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, elapsed):
+    """Per-scenario and overall stats from (scenario, seconds, queries, status)."""
+
+    def stats(rows):
+        latencies = sorted(seconds * 1000 for _, seconds, _, _ in rows)
+        return dict(
+            requests=len(rows),
+            errors=sum(1 for *_, status in rows if status >= 500 or status == 429),
+            throughput=round(len(rows) / elapsed, 2),
+            p50_ms=round(percentile(latencies, 50), 2),
+            p95_ms=round(percentile(latencies, 95), 2),
+            p99_ms=round(percentile(latencies, 99), 2),
+            queries_per_request=round(
+                sum(queries for _, _, queries, _ in rows) / len(rows), 2),
+        )
+
+    by_scenario = {}
+    for sample in samples:
+        by_scenario.setdefault(sample[0], []).append(sample)
+
+    return dict(
+        overall=stats(samples),
+        scenarios={name: stats(rows) for name, rows in sorted(by_scenario.items())},
+    )
+
+
+def run(args, mix):
+    os.environ['DATABASE_URL'] = args.database_url
+    # every simulated client comes from the same address
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    sys.path.insert(0, ROOT)
+
+    from app import app
+    from models import db, Follows
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        if not args.skip_seed:
+            seed_database(args)
+
+        num_users = db.session.execute('SELECT COUNT(*) FROM users').scalar()
+        num_messages = db.session.execute('SELECT MAX(id) FROM messages').scalar() or 1
+
+        rng = random.Random(args.seed)
+        vusers = []
+        for i in range(args.concurrency):
+            user_id = rng.randint(1, num_users)
+            following = {followed for (followed,) in db.session
+                         .query(Follows.user_being_followed_id)
+                         .filter(Follows.user_following_id == user_id)}
+            vusers.append(VirtualUser(app, user_id, following, num_users,
+                                      num_messages, seed=f'{args.seed}-{i}'))
+        db.session.remove()
+
+    counter = QueryCounter(db.engine)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    samples = []
+    samples_lock = threading.Lock()
+    remaining = [args.requests]
+
+    def worker(vu):
+        while True:
+            with samples_lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+
+            name = vu.rng.choices(names, weights)[0]
+            counter.reset()
+            start = time.perf_counter()
+            resp = SCENARIOS[name](vu)
+            seconds = time.perf_counter() - start
+
+            with samples_lock:
+                samples.append((name, seconds, counter.count, resp.status_code))
+
+    # A few untimed requests so first-hit costs (template compilation,
+    # connection setup) don't land in the results
+    for vu in vusers:
+        for name in names:
+            SCENARIOS[name](vu)
+
+    threads = [threading.Thread(target=worker, args=(vu,)) for vu in vusers]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return summarize(samples, elapsed)
+
+
+##############################################################################
+# Reporting
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_table(results, baseline=None):
+    """Print per-scenario results, with changes against `baseline` if given."""
+
+    header = f"{'scenario':<10} {'reqs':>6} {'err':>4} {'rps':>8} " \
+             f"{'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8}"
+    print(header)
+
+    rows = dict(results['scenarios'], overall=results['overall'])
+    for name, row in rows.items():
+        line = (f"{name:<10} {row['requests']:>6} {row['errors']:>4} "
+                f"{row['throughput']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+                f"{row['p99_ms']:>8} {row['queries_per_request']:>8}")
+
+        old = baseline and (baseline['overall'] if name == 'overall'
+                            else baseline['scenarios'].get(name))
+        if old:
+            line += (f"   p95 {change(old['p95_ms'], row['p95_ms'])}"
+                     f"  queries {change(old['queries_per_request'], row['queries_per_request'])}")
+        print(line)
+
+
+def change(old, new):
+    if not old:
+        return 'n/a'
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def regressions(results, baseline, max_regression):
+    """Scenarios whose p95 latency grew by more than `max_regression` percent."""
+
+    worse = []
+    for name, row in results['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old and old['p95_ms'] and \
+                (row['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 > max_regression:
+            worse.append(name)
+    return worse
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warbler route load test.")
+    parser.add_argument('--database-url', default='postgresql:///warbler-bench')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--mix', type=parse_mix,
+                        default=DEFAULT_MIX,
+                        help="weighted scenarios, e.g. homepage=3,profile=1 "
+                             f"(choices: {', '.join(SCENARIOS)})")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="results JSON from an earlier run")
+    parser.add_argument('--max-regression', type=float,
+                        help="with --compare, fail if any scenario's p95 "
+                             "latency grew by more than this percent")
+    args = parser.parse_args(argv)
+
+    results = run(args, args.mix)
+    results['meta'] = dict(
+        commit=git_commit(),
+        date=datetime.now().isoformat(timespec='seconds'),
+        users=args.users,
+        messages=args.messages,
+        follows=args.follows,
+        seed=args.seed,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        mix=args.mix,
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print_table(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if baseline and args.max_regression is not None:
+        worse = regressions(results, baseline, args.max_regression)
+        if worse:
+            print(f"p95 regressed by more than {args.max_regression}%: "
+                  f"{', '.join(worse)}", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
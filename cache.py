@@ -0,0 +1,157 @@
+"""Small key/value caches for Warbler.
+
+`LRUCache` is a bounded, thread-safe, in-process cache with per-entry
+expiry. `RedisCache` has the same interface but keeps entries in Redis,
+so every worker process shares them. It is only used when
+`CACHE_REDIS_URL` is configured, and only then is the `redis` package
+needed. Values are stored in Redis as JSON, so they must be plain
+strings, numbers, lists and dicts.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """In-process cache holding at most `max_size` entries.
+
+    Entries expire `ttl` seconds after they were set (never, if ttl is
+    None); the least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the value cached for `key`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` for `key`, evicting the oldest entry if full."""
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """Forget `keys`, if they are cached."""
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Snapshot of size and hit/miss counters."""
+
+        with self._lock:
+            return dict(size=len(self._entries),
+                        max_size=self.max_size,
+                        hits=self.hits,
+                        misses=self.misses)
+
+
+class RedisCache:
+    """Cache shared between processes through a Redis server.
+
+    Keys are namespaced with `prefix`. Redis enforces its own memory
+    limits and eviction, so there is no `max_size` here.
+    """
+
+    def __init__(self, url, prefix, ttl=None):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        """Return the value cached for `key`, or None."""
+
+        raw = self.client.get(self._key(key))
+
+        if raw is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` for `key`."""
+
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self._key(key), json.dumps(value), ex=ttl)
+
+    def delete(self, *keys):
+        """Forget `keys`, if they are cached."""
+
+        if keys:
+            self.client.delete(*[self._key(key) for key in keys])
+
+    def clear(self):
+        """Forget everything under this cache's prefix."""
+
+        for key in self.client.scan_iter(f"{self.prefix}:*"):
+            self.client.delete(key)
+
+    def stats(self):
+        """Hit/miss counters for this process."""
+
+        return dict(hits=self.hits, misses=self.misses)
+
+
+def make_cache(app, prefix, max_size, ttl=None):
+    """Build the cache the app is configured for.
+
+    A shared `RedisCache` if CACHE_REDIS_URL is set, else an in-process
+    `LRUCache` holding up to `max_size` entries.
+    """
+
+    redis_url = app.config.get('CACHE_REDIS_URL')
+
+    if redis_url:
+        return RedisCache(redis_url, prefix=prefix, ttl=ttl)
+
+    return LRUCache(max_size=max_size, ttl=ttl)
@@ -0,0 +1,111 @@
+"""Denormalized per-user counters for Warbler.
+
+`User` carries running totals of its messages, follows, followers and
+likes so stats can be rendered without loading whole collections. The
+routes that change those relationships call in here; `reconcile()`
+recomputes everything from the underlying tables to repair any drift.
+"""
+
+from sqlalchemy import func, select
+
+from models import db, User, Message, Follows, Likes
+
+
+def adjust(user_id, **deltas):
+    """Atomically add `deltas` (e.g. likes_count=1) to one user's counters."""
+
+    if not deltas:
+        return
+
+    changes = {getattr(User, name): getattr(User, name) + delta
+               for name, delta in deltas.items()}
+
+    (User
+     .query
+     .filter(User.id == user_id)
+     .update(changes, synchronize_session=False))
+
+
+def _decrement_where(name, id_query):
+    """Take one off counter `name` for each user id that `id_query` yields.
+
+    `id_query` may yield an id more than once; counts are per row.
+    """
+
+    ids = id_query.subquery()
+    id_column = list(ids.c)[0]
+    occurrences = (select([func.count()])
+                   .where(id_column == User.id)
+                   .as_scalar())
+    column = getattr(User, name)
+
+    (User
+     .query
+     .filter(User.id.in_(select([id_column])))
+     .update({column: column - occurrences}, synchronize_session=False))
+
+
+def forget_message(message_id):
+    """Update counters for a message that is about to be deleted."""
+
+    forget_messages([message_id])
+
+
+def forget_messages(message_ids):
+    """Update counters for messages that are about to be deleted."""
+
+    authors = (db.session
+               .query(Message.user_id)
+               .filter(Message.id.in_(message_ids)))
+    _decrement_where('messages_count', authors)
+
+    likers = (db.session
+              .query(Likes.user_id)
+              .filter(Likes.message_id.in_(message_ids)))
+    _decrement_where('likes_count', likers)
+
+
+def forget_user(user_id):
+    """Update other users' counters for a user who is about to be deleted."""
+
+    followed = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))
+    _decrement_where('followers_count', followed)
+
+    followers = (db.session
+                 .query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == user_id))
+    _decrement_where('following_count', followers)
+
+    likers = (db.session
+              .query(Likes.user_id)
+              .join(Message, Message.id == Likes.message_id)
+              .filter(Message.user_id == user_id,
+                      Likes.user_id != user_id))
+    _decrement_where('likes_count', likers)
+
+
+def reconcile(conn=None, user_ids=None):
+    """Recompute users' counters from the underlying tables.
+
+    Covers every user unless given `user_ids`. Runs in the session unless
+    a connection `conn` is given (as the migrations do).
+    """
+
+    def count(column, where):
+        return select([func.count(column)]).where(where).as_scalar()
+
+    users = User.__table__
+    statement = users.update().values(
+        messages_count=count(Message.id, Message.user_id == users.c.id),
+        following_count=count(Follows.user_being_followed_id,
+                              Follows.user_following_id == users.c.id),
+        followers_count=count(Follows.user_following_id,
+                              Follows.user_being_followed_id == users.c.id),
+        likes_count=count(Likes.id, Likes.user_id == users.c.id),
+    )
+    if user_ids is not None:
+        statement = statement.where(users.c.id.in_(user_ids))
+
+    (conn or db.session).execute(statement)
@@ -0,0 +1,110 @@
+"""Database connection pool settings and statistics for Warbler.
+
+Pool size, overflow, checkout timeout, recycling and pre-ping come from
+the app's DATABASE_POOL_* settings, so they can be sized to the number of
+workers. With DATABASE_PGBOUNCER on, the app keeps no pool of its own
+and opens a connection per checkout, leaving pooling to pgbouncer in
+transaction mode. (psycopg2 never uses server-side prepared statements,
+so nothing else needs to change for that mode.)
+
+Every pool counts its checkouts, how long they waited for a connection
+and how many timed out. `engine_stats()` reports those, along with how
+many connections are checked out and in overflow, for /metrics.
+"""
+
+import threading
+import time
+
+from flask_sqlalchemy import SQLAlchemy, get_state
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+class _TimedCheckout:
+    """Pool mixin recording how long each checkout waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+        return conn
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedNullPool(_TimedCheckout, NullPool):
+    pass
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with pool settings taken from the app's config."""
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+
+        # Flask-SQLAlchemy picks the right (Null or Static) pool for SQLite
+        if info.drivername.startswith('sqlite'):
+            return
+
+        if app.config.get('DATABASE_PGBOUNCER'):
+            options['poolclass'] = TimedNullPool
+            return
+
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=app.config.get('DATABASE_POOL_SIZE', 5),
+            max_overflow=app.config.get('DATABASE_MAX_OVERFLOW', 10),
+            pool_timeout=app.config.get('DATABASE_POOL_TIMEOUT', 30),
+            pool_recycle=app.config.get('DATABASE_POOL_RECYCLE', -1),
+            pool_pre_ping=app.config.get('DATABASE_POOL_PRE_PING', True),
+        )
+
+
+def engine_stats(app, bind=None):
+    """Pool statistics for one of `app`'s engines (None for the primary)."""
+
+    pool = get_state(app).db.get_engine(app, bind=bind).pool
+    stats = {}
+
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            idle=pool.checkedin(),
+        )
+
+    if isinstance(pool, _TimedCheckout):
+        with pool._stats_lock:
+            checkouts = pool.checkouts
+            stats.update(
+                checkouts=checkouts,
+                timeouts=pool.timeouts,
+                wait_ms=round(pool.wait_seconds * 1000, 2),
+                avg_wait_ms=round(pool.wait_seconds * 1000 / (checkouts or 1), 3),
+                max_wait_ms=round(pool.max_wait_seconds * 1000, 2),
+            )
+
+    return stats
@@ -1,6 +1,45 @@
+import ipaddress
+from urllib.parse import urlsplit
+
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileAllowed, FileField
 from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import DataRequired, Email, Length
+from wtforms.validators import DataRequired, Email, Length, ValidationError
+
+from images import is_public_address
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
+# The app's own images, which may be given by path
+LOCAL_IMAGE_PREFIXES = ('/static/', '/images/uploads/')
+
+
+def image_source(form, field):
+    """Accept only http(s) image URLs (or the app's own images).
+
+    Hosts given as an address must be public; names are checked again
+    when the image is fetched (see images.py).
+    """
+
+    url = (field.data or '').strip()
+    if not url or url.startswith(LOCAL_IMAGE_PREFIXES):
+        return
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValidationError('Enter an http:// or https:// image URL.')
+
+    host = parts.hostname
+    if host == 'localhost' or host.endswith('.localhost'):
+        raise ValidationError('Images must be on a public host.')
+
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return
+
+    if not is_public_address(host):
+        raise ValidationError('Images must be on a public host.')
 
 
 class MessageForm(FlaskForm):
@@ -15,7 +54,7 @@ class UserAddForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
-    image_url = StringField('(Optional) Image URL')
+    image_url = StringField('(Optional) Image URL', validators=[image_source])
 
 
 class LoginForm(FlaskForm):
@@ -28,8 +67,13 @@ class UserEditForm(FlaskForm):
     """Form for updating your profile"""
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('E-mail', validators=[DataRequired(), Email()])
-    image_url = StringField('(Optional) Image URL')
-    header_image_url = StringField('(Optional) Header Image URL')
+    image_url = StringField('(Optional) Image URL', validators=[image_source])
+    image_file = FileField('(Optional) Upload an image',
+                           validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
+    header_image_url = StringField('(Optional) Header Image URL',
+                                   validators=[image_source])
+    header_image_file = FileField('(Optional) Upload a header image',
+                                  validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
     bio = StringField('Bio')
     location = StringField('Location')
     password = PasswordField('Password', validators=[Length(min=6)])
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""Cached HTML fragments for message list items.
+
+A message's text, author and timestamp never change once it's posted,
+so the HTML for its list item (templates/messages/_item.html) is rendered
+once and reused. Cache keys include the author's `version`, which the
+profile page bumps, so an author's new name or avatar takes effect
+straight away. Anything that depends on the viewer, like the like button,
+is rendered around the fragment, never inside it.
+"""
+
+from flask import render_template
+from markupsafe import Markup
+
+from cache import make_cache
+
+DEFAULT_SIZE = 10000
+
+cache = None
+
+
+def init_app(app):
+    """Create the fragment cache and expose `message_fragment` to templates.
+
+    A FRAGMENT_CACHE_SIZE of 0 turns caching off.
+    """
+
+    global cache
+
+    size = app.config.get('FRAGMENT_CACHE_SIZE', DEFAULT_SIZE)
+    cache = make_cache(app, 'fragment', max_size=size) if size else None
+
+    app.jinja_env.globals['message_fragment'] = message_fragment
+
+
+def message_fragment(msg):
+    """The inner HTML of `msg`'s list item, from the cache when possible."""
+
+    if cache is None:
+        return Markup(render_template('messages/_item.html', msg=msg))
+
+    key = f"message:{msg.id}:{msg.user_id}:{msg.user.version}"
+    html = cache.get(key)
+
+    if html is None:
+        html = render_template('messages/_item.html', msg=msg)
+        cache.set(key, html)
+
+    return Markup(html)
@@ -3,13 +3,32 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Everything is generated offline and streamed to disk a chunk at a time,
+so datasets far larger than memory can be produced, e.g. for benchmarks:
+
+    python generator/create_csvs.py --users 1000000 --messages 50000000 \\
+        --follows 20000000 --seed 42 --workers 8 --out-dir bench-data
+
+The same --seed (and --now) always gives the same files, however many
+workers are used. Who gets followed, and who posts, follows a power law
+(Zipf), so a few accounts are very popular and most have a handful of
+followers.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import io
+import random
+import sys
+import time
+from bisect import bisect
+from datetime import datetime
+from itertools import accumulate
+from multiprocessing import Pool
+
 from faker import Faker
+from faker.providers.lorem.en_US import Provider as LoremProvider
 from helpers import get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
@@ -20,11 +39,15 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
 
-fake = Faker()
+CHUNK_SIZE = 10000
 
-# Generate random profile image URLs to use for users
+# Every generated user shares this precomputed bcrypt hash
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Profile image URLs to use for users (only the URLs are generated; nothing
+# is fetched)
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +55,215 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header images bundled with the app, so no third-party host is needed
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+# Faker's paragraph() is the slowest part of generating messages, so warble
+# text is built straight from its word list instead
+
+WORDS = LoremProvider.word_list
+
+
+def warble_text(rng):
+    """A few random sentences, cut to the maximum warble length."""
+
+    sentences = []
+    for _ in range(rng.randint(1, 4)):
+        words = rng.choices(WORDS, k=rng.randint(4, 12))
+        sentences.append(' '.join(words).capitalize() + '.')
+
+    return ' '.join(sentences)[:MAX_WARBLER_LENGTH]
+
+
+class Dataset:
+    """Sizes, seed and popularity distribution shared by every chunk."""
+
+    def __init__(self, num_users, num_messages, num_follows, seed, zipf, now):
+        self.num_users = num_users
+        self.num_messages = num_messages
+        self.num_follows = num_follows
+        self.seed = seed
+        self.now = now
+
+        # Popularity rank -> user id, shuffled so popular users aren't
+        # simply the lowest ids; a separate ranking decides who posts most.
+        self.by_popularity = list(range(1, num_users + 1))
+        self.rng('popularity', 0).shuffle(self.by_popularity)
+
+        self.by_activity = list(range(1, num_users + 1))
+        self.rng('activity', 0).shuffle(self.by_activity)
+
+        self.cum_weights = list(accumulate(
+            1 / rank ** zipf for rank in range(1, num_users + 1)))
+
+    def rng(self, kind, index):
+        """A random generator unique to (and repeatable for) one chunk."""
+
+        return random.Random(f"{self.seed}-{kind}-{index}")
+
+    def pick(self, ranking, rng):
+        """Draw a user id from `ranking`, weighted by Zipf on rank."""
+
+        total = self.cum_weights[-1]
+        rank = bisect(self.cum_weights, rng.random() * total)
+        return ranking[min(rank, self.num_users - 1)]
+
+
+def user_rows(dataset, index, start, stop):
+    rng = dataset.rng('users', index)
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(32))
+
+    for user_id in range(start + 1, stop + 1):
+        # Suffix with the id so usernames and emails are always unique
+        username = f"{fake.user_name()}{user_id}"
+
+        yield dict(
+            email=f"{username}@{fake.free_email_domain()}",
+            username=username,
+            image_url=rng.choice(image_urls),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(header_image_urls),
             location=fake.city()
-        ))
+        )
+
+
+def message_rows(dataset, index, start, stop):
+    rng = dataset.rng('messages', index)
+
+    for _ in range(start, stop):
+        yield dict(
+            text=warble_text(rng),
+            timestamp=get_random_datetime(rng=rng, now=dataset.now),
+            user_id=dataset.pick(dataset.by_activity, rng)
+        )
+
+
+def follow_rows(dataset, index, start, stop):
+    """Follows for followers `start + 1` to `stop`.
+
+    Each follower follows an (almost) equal share of --follows distinct
+    users, drawn by popularity, so follower counts follow a power law.
+    Pairs are deduplicated per follower, so memory stays proportional to
+    one follower's follows, never to all pairs.
+    """
+
+    rng = dataset.rng('follows', index)
+    share, extra = divmod(dataset.num_follows, dataset.num_users)
+
+    for follower in range(start + 1, stop + 1):
+        wanted = min(share + (follower <= extra), dataset.num_users - 1)
+        followed = set()
+
+        # Popular users get drawn over and over; give up on sampling after
+        # a while and top up from the popularity ranking instead.
+        for _ in range(wanted * 20):
+            if len(followed) == wanted:
+                break
+            user_id = dataset.pick(dataset.by_popularity, rng)
+            if user_id != follower:
+                followed.add(user_id)
+
+        for user_id in dataset.by_popularity:
+            if len(followed) == wanted:
+                break
+            if user_id != follower:
+                followed.add(user_id)
+
+        for user_id in followed:
+            yield dict(user_being_followed_id=user_id, user_following_id=follower)
+
+
+# name -> (headers, row generator, Dataset attribute holding the row count).
+# Follows are generated per follower, so their chunks count followers.
+TABLES = {
+    'users': (USERS_CSV_HEADERS, user_rows, 'num_users'),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows, 'num_messages'),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows, 'num_users'),
+}
+
+_dataset = None
+
+
+def _init_worker(dataset_args):
+    global _dataset
+    _dataset = Dataset(*dataset_args)
+
+
+def render_chunk(job):
+    """Generate one chunk of a table and return it as CSV text."""
+
+    name, index, start, stop = job
+    headers, rows, _ = TABLES[name]
+
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=headers)
+    writer.writerows(rows(_dataset, index, start, stop))
+    return out.getvalue()
+
+
+def chunk_jobs(name, total, chunk_size):
+    for index, start in enumerate(range(0, total, chunk_size)):
+        yield name, index, start, min(start + chunk_size, total)
+
+
+def generate(dataset_args, out_dir, workers, chunk_size):
+    """Write users.csv, messages.csv and follows.csv into `out_dir`."""
+
+    _init_worker(dataset_args)
+    pool = Pool(workers, _init_worker, (dataset_args,)) if workers > 1 else None
+    imap = pool.imap if pool else map
+
+    try:
+        for name, (headers, _, size_attr) in TABLES.items():
+            total = getattr(_dataset, size_attr)
+            start = time.perf_counter()
+
+            with open(f"{out_dir}/{name}.csv", 'w', newline='') as csv_file:
+                csv.DictWriter(csv_file, fieldnames=headers).writeheader()
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+                jobs = chunk_jobs(name, total, chunk_size)
+                for done, text in enumerate(imap(render_chunk, jobs), 1):
+                    csv_file.write(text)
+                    print(f"{name}: {min(done * chunk_size, total):,}/{total:,} "
+                          f"({time.perf_counter() - start:.1f}s)",
+                          file=sys.stderr, flush=True)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
 
-# Generate follows.csv from random pairings of users
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for reproducible output")
+    parser.add_argument('--now', type=datetime.fromisoformat,
+                        default=datetime.now().replace(microsecond=0),
+                        help="latest message timestamp, as ISO 8601 "
+                             "(default: the current time)")
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help="power-law exponent for popularity/activity")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes generating chunks in parallel")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args(argv)
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    dataset_args = (args.users, args.messages, args.follows,
+                    args.seed, args.zipf, args.now)
+    generate(dataset_args, args.out_dir, args.workers, args.chunk_size)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
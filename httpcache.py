@@ -0,0 +1,86 @@
+"""HTTP caching policy for Warbler's responses.
+
+Every response gets a Cache-Control header from one place:
+
+- pages shown to anonymous visitors are public, so browsers and any
+  proxy in front of the app may keep them for HTTP_CACHE_MAX_AGE seconds
+  (they carry `Vary: Cookie`, so a logged-in visitor never gets them);
+- pages for a logged-in user, or that set a cookie, are private and
+  revalidated on every use;
+- anything that isn't a successful GET (form posts, redirects, errors)
+  isn't stored at all.
+
+Static files keep the headers Flask's static view gives them, and a view
+that sets its own Cache-Control keeps it.
+
+Views whose content can be summed up by a few row versions call
+`validate()` before rendering. It tags the response with an ETag and, if
+the client already holds that version, hands back a 304 so the page
+isn't built again.
+"""
+
+import hashlib
+
+from flask import current_app, g, request, session
+
+DEFAULT_MAX_AGE = 60
+
+
+def is_personalized():
+    """Will this response differ for (or set a cookie on) this visitor?"""
+
+    return (g.get('user') is not None
+            or session.modified
+            or '_flashes' in session)
+
+
+def validate(*parts):
+    """Tag this response with an ETag made from `parts`.
+
+    `parts` should be everything the page depends on, e.g. row ids and
+    versions plus the query arguments. Returns a 304 response when the
+    client's copy is current, otherwise None. Personalized responses are
+    never validated.
+    """
+
+    if is_personalized():
+        return None
+
+    g.etag = hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    if request.if_none_match.contains_weak(g.etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def apply_policy(response):
+    """Set Cache-Control (and the ETag, if any) on `response`."""
+
+    if request.endpoint == 'static' or 'Cache-Control' in response.headers:
+        return response
+
+    if request.method not in ('GET', 'HEAD') or \
+            response.status_code not in (200, 304):
+        response.cache_control.no_store = True
+
+    elif is_personalized():
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get(
+            'HTTP_CACHE_MAX_AGE', DEFAULT_MAX_AGE)
+        response.vary.add('Cookie')
+
+        if 'etag' in g:
+            response.set_etag(g.etag)
+
+    return response
+
+
+def init_app(app):
+    """Install the caching policy on every response from `app`."""
+
+    app.after_request(apply_policy)
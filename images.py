@@ -0,0 +1,501 @@
+"""Local proxy and thumbnail cache for user avatars and header images.
+
+Users' images can live on any host and are often far bigger than the
+48px avatars in a timeline. Templates therefore link to them through
+`image_url(url, variant)`, which points at this app instead:
+
+    /images/<variant>/<token>
+
+The token is the source URL signed with the app's SECRET_KEY, so the
+proxy only fetches URLs the app itself rendered. Those are whatever users
+typed in, though, so remote images are fetched over http(s) only, and
+every connection, including each redirect, is refused unless the host
+resolves only to public addresses. Private, loopback, link-local and
+reserved addresses are off limits (tests can allow them with
+IMAGE_FETCH_ALLOW_PRIVATE).
+
+The first request for a source fetches it once, stores every variant
+(resized to fill VARIANTS) on disk under a name made from a hash of its
+content, and redirects to the one asked for. Later requests redirect
+straight away, and the stored files are served as immutable, so
+browsers keep them for a year.
+
+The cache directory (IMAGE_CACHE_DIR) is held to IMAGE_CACHE_MAX_BYTES.
+Each process keeps a running total of what it has stored, and once that
+passes the limit the least recently served files are removed until it
+fits again. They are simply fetched again if asked for. Uploaded images
+are kept separately and never evicted, since they have no other copy.
+
+Resizing needs Pillow; without it, variants are the source image as is.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+from flask import (abort, current_app, redirect, safe_join,
+                   send_from_directory, url_for)
+from itsdangerous import BadSignature, URLSafeSerializer
+
+# (width, height) each variant is cropped and resized to fill
+VARIANTS = {
+    'timeline': (48, 48),
+    'card': (200, 200),
+    'header': (1200, 360),
+}
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+DEFAULT_FETCH_TIMEOUT = 5
+MAX_REDIRECTS = 3
+
+FETCH_SCHEMES = ('http', 'https')
+
+# Served files are marked as used at most this often (seconds)
+TOUCH_INTERVAL = 3600
+
+# Evict down to this fraction of the limit, so evictions are rare
+EVICT_TO = 0.9
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REDIRECT_MAX_AGE = 86400
+
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+
+class ImageError(Exception):
+    """Raised when a source can't be read, or isn't an image."""
+
+
+def init_app(app):
+    """Add the image routes and the `image_url` template helper to `app`."""
+
+    app.config.setdefault('IMAGE_CACHE_DIR',
+                          os.path.join(app.instance_path, 'images'))
+    app.config.setdefault('IMAGE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+    app.config.setdefault('IMAGE_MAX_SOURCE_BYTES', DEFAULT_MAX_SOURCE_BYTES)
+    app.config.setdefault('IMAGE_FETCH_TIMEOUT', DEFAULT_FETCH_TIMEOUT)
+    app.config.setdefault('IMAGE_FETCH_ALLOW_PRIVATE', False)
+
+    variants = ', '.join(VARIANTS)
+    app.add_url_rule(f'/images/<any({variants}):variant>/<token>',
+                     'image_proxy', proxy_view)
+    app.add_url_rule('/images/files/<name>', 'image_file', file_view)
+    app.add_url_rule('/images/uploads/<name>', 'image_upload', upload_view)
+
+    app.jinja_env.globals['image_url'] = image_url
+
+
+def _dir(name):
+    path = os.path.join(current_app.config['IMAGE_CACHE_DIR'], name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='images')
+
+
+def image_url(url, variant):
+    """Where to load the `variant` of the image at `url` from."""
+
+    if not url:
+        return url
+
+    return url_for('image_proxy', variant=variant,
+                   token=_serializer().dumps(url))
+
+
+##############################################################################
+# Reading and storing images
+
+
+def _sniff(data):
+    """The file extension for image `data`, or None if it isn't one."""
+
+    for signature, extension in SIGNATURES:
+        if data.startswith(signature):
+            return extension
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+
+    return None
+
+
+def _read_limited(stream):
+    limit = current_app.config['IMAGE_MAX_SOURCE_BYTES']
+    data = stream.read(limit + 1)
+
+    if len(data) > limit:
+        raise ImageError("image is too large")
+
+    return data
+
+
+##############################################################################
+# Fetching remote images
+
+
+def is_public_address(address):
+    """Is the IP `address` on the public internet?"""
+
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if getattr(ip, 'ipv4_mapped', None):
+        ip = ip.ipv4_mapped
+
+    return ip.is_global and not ip.is_multicast
+
+
+def _public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                       source_address=None):
+    """Connect like socket.create_connection, but only to a public address.
+
+    The host is resolved once and every address it resolves to is vetted
+    before any connection is made; the socket then connects to those same
+    addresses. http.client still sends the original name in the Host
+    header, and as the SNI name when it wraps the socket in TLS.
+    """
+
+    host, port = address
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+    if not current_app.config['IMAGE_FETCH_ALLOW_PRIVATE']:
+        for *_, sockaddr in infos:
+            if not is_public_address(sockaddr[0]):
+                raise ImageError(f"{host} is not a public address")
+
+    error = None
+    for family, type_, proto, _, sockaddr in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as exc:
+            sock.close()
+            error = exc
+
+    raise error or OSError(f"can't resolve {host}")
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _public_connection
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _public_connection
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow a few redirects, to http(s) URLs only."""
+
+    max_redirections = MAX_REDIRECTS
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urlsplit(newurl).scheme not in FETCH_SCHEMES:
+            raise ImageError(f"won't follow a redirect to {newurl}")
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def _opener():
+    """A URL opener that only speaks http(s), to public addresses."""
+
+    opener = urllib.request.OpenerDirector()
+    for handler in [_PublicHTTPHandler(),
+                    _PublicHTTPSHandler(),
+                    _RedirectHandler(),
+                    urllib.request.HTTPDefaultErrorHandler(),
+                    urllib.request.HTTPErrorProcessor(),
+                    urllib.request.UnknownHandler()]:
+        opener.add_handler(handler)
+    return opener
+
+
+def _fetch(url):
+    """The bytes of the remote image at `url`."""
+
+    if urlsplit(url).scheme not in FETCH_SCHEMES:
+        raise ImageError(f"can't fetch {url}")
+
+    request = urllib.request.Request(url, headers={'User-Agent': 'Warbler'})
+    try:
+        with _opener().open(request,
+                            timeout=current_app.config['IMAGE_FETCH_TIMEOUT']) as resp:
+            return _read_limited(resp)
+    except (OSError, ValueError, http.client.HTTPException) as exc:
+        raise ImageError(f"can't fetch {url}: {exc}")
+
+
+def _read_source(url):
+    """The bytes of the image at `url`: a static file, upload or web URL."""
+
+    static = url_for('static', filename='')
+    uploads = url_for('image_upload', name='')
+
+    if url.startswith(static):
+        path = safe_join(current_app.static_folder, url[len(static):])
+    elif url.startswith(uploads):
+        path = safe_join(_dir('uploads'), url[len(uploads):])
+    else:
+        return _fetch(url)
+
+    try:
+        with open(path, 'rb') as file:
+            return _read_limited(file)
+    except OSError as exc:
+        raise ImageError(f"can't read {url}: {exc}")
+
+
+def _resize(data, size):
+    """`data` cropped and resized to fill `size`, as (bytes, extension)."""
+
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.fit(ImageOps.exif_transpose(image), size,
+                                 Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ImageError(f"can't resize image: {exc}")
+
+    out = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'png'
+
+    image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True,
+                              progressive=True)
+    return out.getvalue(), 'jpg'
+
+
+def _make_variants(data):
+    """{variant: (bytes, extension)} for image `data`."""
+
+    extension = _sniff(data)
+    if extension is None:
+        raise ImageError("not an image")
+
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return {variant: (data, extension) for variant in VARIANTS}
+
+    return {variant: _resize(data, size) for variant, size in VARIANTS.items()}
+
+
+def _write(directory, name, data):
+    """Write a file atomically, so a reader never sees half of it."""
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, os.path.join(directory, name))
+
+
+def _store(directory, name, data):
+    """Write a cache file unless it's there already; returns bytes added."""
+
+    if os.path.exists(os.path.join(directory, name)):
+        return 0
+
+    _write(directory, name, data)
+    return len(data)
+
+
+def _content_name(data, extension):
+    return f"{hashlib.sha256(data).hexdigest()[:32]}.{extension}"
+
+
+def _index_name(url):
+    return f"{hashlib.sha1(url.encode()).hexdigest()}.json"
+
+
+def variant_name(url, variant):
+    """The stored file name for `variant` of `url`, fetching it if need be."""
+
+    files = _dir('files')
+    index = os.path.join(_dir('sources'), _index_name(url))
+
+    try:
+        with open(index) as file:
+            name = json.load(file)[variant]
+        if os.path.exists(os.path.join(files, name)):
+            return name
+    except (OSError, ValueError, KeyError):
+        pass
+
+    names = {}
+    added = 0
+    for key, (data, extension) in _make_variants(_read_source(url)).items():
+        names[key] = _content_name(data, extension)
+        added += _store(files, names[key], data)
+
+    index = json.dumps(names).encode()
+    _write(_dir('sources'), _index_name(url), index)
+    _note_stored(added + len(index))
+
+    return names[variant]
+
+
+def store_upload(file):
+    """Keep an uploaded image (a FileStorage); returns the URL to use for it."""
+
+    data = _read_limited(file.stream)
+
+    extension = _sniff(data)
+    if extension is None:
+        raise ImageError("not an image")
+
+    name = _content_name(data, extension)
+    _write(_dir('uploads'), name, data)
+
+    return url_for('image_upload', name=name)
+
+
+# Bytes this process believes each cache directory holds
+_stored_bytes = {}
+_stored_lock = threading.Lock()
+
+
+def _cache_entries():
+    """(mtime, size, path) of every evictable file in the cache."""
+
+    entries = []
+    for directory in [_dir('files'), _dir('sources')]:
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def _note_stored(added):
+    """Count `added` bytes towards the cache size; evict if it's too big.
+
+    The directory is only scanned the first time and when the total
+    passes the limit. Other processes' stores aren't counted until then,
+    so the cache can briefly run over by what they've added.
+    """
+
+    cache_dir = current_app.config['IMAGE_CACHE_DIR']
+
+    with _stored_lock:
+        if cache_dir not in _stored_bytes:
+            _stored_bytes[cache_dir] = sum(size for _, size, _ in _cache_entries())
+        _stored_bytes[cache_dir] += added
+        full = _stored_bytes[cache_dir] > current_app.config['IMAGE_CACHE_MAX_BYTES']
+
+    if full:
+        evict()
+
+
+def evict():
+    """Remove the least recently served files while the cache is too big."""
+
+    limit = current_app.config['IMAGE_CACHE_MAX_BYTES']
+
+    with _stored_lock:
+        entries = _cache_entries()
+        total = sum(size for _, size, _ in entries)
+
+        if total > limit:
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+                if total <= limit * EVICT_TO:
+                    break
+
+        _stored_bytes[current_app.config['IMAGE_CACHE_DIR']] = total
+
+
+##############################################################################
+# Views
+
+
+def proxy_view(variant, token):
+    """Redirect to the stored `variant` of the image the token names."""
+
+    try:
+        url = _serializer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    try:
+        name = variant_name(url, variant)
+    except ImageError as exc:
+        current_app.logger.warning("image proxy: %s", exc)
+        if url.startswith(('http://', 'https://')):
+            # Let the browser try the origin itself (not cached, see httpcache)
+            return redirect(url)
+        abort(404)
+
+    response = redirect(url_for('image_file', name=name))
+    response.headers['Cache-Control'] = f'public, max-age={REDIRECT_MAX_AGE}'
+    return response
+
+
+def _serve(directory, name):
+    response = send_from_directory(directory, name)
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def file_view(name):
+    """Serve a stored variant, noting that it's been used."""
+
+    path = safe_join(_dir('files'), name)
+
+    try:
+        if os.stat(path).st_mtime < time.time() - TOUCH_INTERVAL:
+            os.utime(path)
+    except OSError:
+        abort(404)
+
+    return _serve(_dir('files'), name)
+
+
+def upload_view(name):
+    """Serve an uploaded image."""
+
+    return _serve(_dir('uploads'), name)
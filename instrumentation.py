@@ -0,0 +1,250 @@
+"""Per-request SQL and rendering instrumentation for Warbler.
+
+Every request records how many SQL statements it ran, how long they took,
+how long template rendering took and its slowest statement. The numbers
+are aggregated per endpoint and served from /metrics (JSON, or the
+Prometheus text format with ?format=prometheus). Each request also emits
+one structured (JSON) log line on the `warbler.requests` logger.
+
+It is cheap enough to leave on in production: the hooks only add a few
+counters to `g`. /metrics shows SQL text and internal stats, so it is
+closed (404) unless a `METRICS_TOKEN` is configured and sent as a bearer
+token. `METRICS_ALLOW_LOCAL` also opens it to requests from localhost;
+only turn that on when no reverse proxy on the same host forwards public
+requests, since they would all come from localhost too.
+"""
+
+import hmac
+import json
+import logging
+import threading
+import time
+
+from flask import (abort, current_app, g, has_request_context, jsonify,
+                   request, before_render_template, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.requests')
+
+LOCAL_ADDRS = {'127.0.0.1', '::1'}
+STATEMENT_PREVIEW = 200
+
+
+class EndpointStats:
+    """Running totals for one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.total_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+
+    def add(self, queries, db_seconds, render_seconds, total_seconds,
+            slowest_seconds, slowest_statement):
+        self.requests += 1
+        self.queries += queries
+        self.max_queries = max(self.max_queries, queries)
+        self.db_seconds += db_seconds
+        self.render_seconds += render_seconds
+        self.total_seconds += total_seconds
+
+        if slowest_seconds > self.slowest_seconds:
+            self.slowest_seconds = slowest_seconds
+            self.slowest_statement = slowest_statement
+
+    def as_dict(self):
+        n = self.requests or 1
+        return dict(
+            requests=self.requests,
+            queries=self.queries,
+            avg_queries=round(self.queries / n, 2),
+            max_queries=self.max_queries,
+            db_ms=round(self.db_seconds * 1000, 2),
+            avg_db_ms=round(self.db_seconds * 1000 / n, 2),
+            avg_render_ms=round(self.render_seconds * 1000 / n, 2),
+            avg_total_ms=round(self.total_seconds * 1000 / n, 2),
+            slowest_statement_ms=round(self.slowest_seconds * 1000, 2),
+            slowest_statement=self.slowest_statement,
+        )
+
+
+class Metrics:
+    """Per-endpoint request stats plus any extra registered sources."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._sources = {}
+
+    def record(self, endpoint, **measurements):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, EndpointStats())
+            stats.add(**measurements)
+
+    def add_source(self, name, fn):
+        """Include `fn()` (a dict of numbers) under `name` in /metrics."""
+
+        self._sources[name] = fn
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {name: stats.as_dict()
+                         for name, stats in sorted(self._endpoints.items())}
+
+        snapshot = dict(endpoints=endpoints)
+        for name, fn in self._sources.items():
+            snapshot[name] = fn()
+        return snapshot
+
+
+metrics = Metrics()
+
+
+##############################################################################
+# Hooks
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if has_request_context():
+        g._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if not has_request_context() or 'request_stats' not in g:
+        return
+
+    seconds = time.perf_counter() - g.pop('_query_start', time.perf_counter())
+    stats = g.request_stats
+    stats['queries'] += 1
+    stats['db_seconds'] += seconds
+
+    if seconds > stats['slowest_seconds']:
+        stats['slowest_seconds'] = seconds
+        stats['slowest_statement'] = ' '.join(statement.split())[:STATEMENT_PREVIEW]
+
+
+# Templates render other templates (message fragments, for one), so only
+# the outermost render is timed; the nested ones are part of it.
+
+def _before_render(sender, template, context, **extra):
+    if 'request_stats' in g:
+        depth = g.get('_render_depth', 0)
+        if not depth:
+            g._render_start = time.perf_counter()
+        g._render_depth = depth + 1
+
+
+def _after_render(sender, template, context, **extra):
+    if 'request_stats' in g and g.get('_render_depth'):
+        g._render_depth -= 1
+        if not g._render_depth:
+            g.request_stats['render_seconds'] += time.perf_counter() - g.pop('_render_start')
+
+
+def _start_request():
+    g.request_stats = dict(queries=0, db_seconds=0.0, render_seconds=0.0,
+                           slowest_seconds=0.0, slowest_statement=None)
+    g._request_start = time.perf_counter()
+
+
+def _finish_request(response):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+
+    stats['total_seconds'] = time.perf_counter() - g._request_start
+    endpoint = request.endpoint or 'unmatched'
+    metrics.record(endpoint, **stats)
+
+    logger.info(json.dumps(dict(
+        event='request',
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+        queries=stats['queries'],
+        db_ms=round(stats['db_seconds'] * 1000, 2),
+        render_ms=round(stats['render_seconds'] * 1000, 2),
+        total_ms=round(stats['total_seconds'] * 1000, 2),
+        slowest_statement=stats['slowest_statement'],
+    )))
+
+    return response
+
+
+##############################################################################
+# /metrics
+
+
+def _prometheus(snapshot):
+    """Render a snapshot in the Prometheus text exposition format."""
+
+    lines = []
+    fields = [('requests', 'warbler_requests_total'),
+              ('queries', 'warbler_queries_total'),
+              ('db_ms', 'warbler_db_milliseconds_total')]
+
+    for key, metric in fields:
+        lines.append(f'# TYPE {metric} counter')
+        for endpoint, stats in snapshot['endpoints'].items():
+            lines.append(f'{metric}{{endpoint="{endpoint}"}} {stats[key]}')
+
+    for source, values in snapshot.items():
+        if source == 'endpoints':
+            continue
+        for key, value in values.items():
+            if isinstance(value, (int, float)):
+                lines.append(f'warbler_{source}_{key} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    """Serve the current metrics to holders of METRICS_TOKEN (or localhost,
+    with METRICS_ALLOW_LOCAL); to everyone else /metrics doesn't exist."""
+
+    token = current_app.config.get('METRICS_TOKEN')
+    authorized = bool(token) and hmac.compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {token}')
+    local = (current_app.config.get('METRICS_ALLOW_LOCAL')
+             and request.remote_addr in LOCAL_ADDRS)
+
+    if not (authorized or local):
+        abort(404)
+
+    snapshot = metrics.snapshot()
+
+    if request.args.get('format') == 'prometheus':
+        return _prometheus(snapshot), 200, {'Content-Type': 'text/plain; version=0.0.4',
+                                            'Cache-Control': 'no-store'}
+
+    return jsonify(snapshot), 200, {'Cache-Control': 'no-store'}
+
+
+def init_app(app):
+    """Install the request, SQL and template hooks on `app`."""
+
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    # Listening on Engine itself covers every engine/bind the app creates
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
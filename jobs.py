@@ -0,0 +1,205 @@
+"""A small database-backed job queue for Warbler's heavy side effects.
+
+Routes `enqueue()` work in the same transaction as the change that needs
+it, so a job exists exactly when that change was committed, and respond
+straight away. A worker process picks the jobs up:
+
+    flask jobs-work
+
+(or, for development, JOBS_WORKER_THREAD=1 runs one inside the web
+process). Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so
+any number can run side by side, and each job runs in its own
+transaction together with its removal from the queue.
+
+Big jobs work in batches: a handler does one batch and returns the
+keyword arguments for the next, which is queued as a new job. A handler
+that raises is retried with exponential backoff, up to MAX_ATTEMPTS
+times. After that the job is kept, marked failed, with its last error.
+"""
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+import counters
+import timeline
+import usercache
+from models import db, Job, Message, User
+
+logger = logging.getLogger('warbler.jobs')
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 10
+
+DELETE_BATCH = 1000
+RECONCILE_BATCH = 1000
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the decorated function as the handler for `kind` jobs."""
+
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+
+    return register
+
+
+def enqueue(kind, **payload):
+    """Queue a `kind` job; it is committed along with the session."""
+
+    job = Job(kind=kind, payload=json.dumps(payload))
+    db.session.add(job)
+    return job
+
+
+def run_one():
+    """Claim and run the next due job. Returns False if none was due."""
+
+    now = datetime.utcnow()
+    job = (Job
+           .query
+           .filter(Job.failed_at.is_(None), Job.run_after <= now)
+           .order_by(Job.run_after, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.rollback()
+        return False
+
+    try:
+        with db.session.begin_nested():
+            more = HANDLERS[job.kind](**json.loads(job.payload))
+
+    except Exception as exc:
+        logger.exception("job %s (%s) failed", job.id, job.kind)
+
+        job.attempts += 1
+        job.last_error = f"{type(exc).__name__}: {exc}"
+        if job.attempts >= MAX_ATTEMPTS:
+            job.failed_at = now
+        else:
+            job.run_after = now + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+
+    else:
+        db.session.delete(job)
+        if more is not None:
+            enqueue(job.kind, **more)
+
+    db.session.commit()
+    return True
+
+
+def run_pending(limit=None):
+    """Run due jobs until there are none left (or `limit` have run)."""
+
+    ran = 0
+    while (limit is None or ran < limit) and run_one():
+        ran += 1
+    return ran
+
+
+def work(poll_interval=1.0, burst=False):
+    """Run jobs forever, polling when the queue is empty.
+
+    With `burst`, return as soon as the queue is empty instead.
+    """
+
+    while True:
+        if run_one():
+            continue
+        if burst:
+            return
+        time.sleep(poll_interval)
+
+
+def start_worker_thread(app, poll_interval=1.0):
+    """Run a worker in a daemon thread of this process."""
+
+    def run():
+        with app.app_context():
+            work(poll_interval)
+
+    thread = threading.Thread(target=run, name='warbler-jobs', daemon=True)
+    thread.start()
+    return thread
+
+
+def stats():
+    """Queue depth for /metrics."""
+
+    now = datetime.utcnow()
+    pending, due, failed = (db.session
+                            .query(func.count(Job.id).filter(Job.failed_at.is_(None)),
+                                   func.count(Job.id).filter(Job.failed_at.is_(None),
+                                                             Job.run_after <= now),
+                                   func.count(Job.failed_at))
+                            .one())
+    return dict(pending=pending, due=due, failed=failed)
+
+
+##############################################################################
+# Handlers
+
+
+@handler('fan_out')
+def fan_out(message_id, after=0):
+    """Deliver a new message to a batch of its author's followers."""
+
+    last = timeline.fan_out(message_id, after=after)
+    if last is not None:
+        return dict(message_id=message_id, after=last)
+
+
+@handler('delete_user')
+def delete_user(user_id):
+    """Delete a batch of a user's messages; then, once none are left, the user.
+
+    Deleting the messages a batch at a time keeps each transaction (and
+    the locks the cascades take) short, however prolific the user was.
+    """
+
+    batch = [message_id for (message_id,) in (
+        db.session
+        .query(Message.id)
+        .filter(Message.user_id == user_id)
+        .order_by(Message.id)
+        .limit(DELETE_BATCH))]
+
+    if batch:
+        counters.forget_messages(batch)
+        (Message
+         .query
+         .filter(Message.id.in_(batch))
+         .delete(synchronize_session=False))
+        return dict(user_id=user_id)
+
+    counters.forget_user(user_id)
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
+    usercache.invalidate(user_id)
+
+
+@handler('reconcile_counters')
+def reconcile_counters(after=0):
+    """Recompute the counters of the next batch of users."""
+
+    batch = [user_id for (user_id,) in (
+        db.session
+        .query(User.id)
+        .filter(User.id > after)
+        .order_by(User.id)
+        .limit(RECONCILE_BATCH))]
+
+    if batch:
+        counters.reconcile(user_ids=batch)
+        usercache.invalidate(*batch)
+
+    if len(batch) == RECONCILE_BATCH:
+        return dict(after=batch[-1])
@@ -0,0 +1,149 @@
+"""Versioned schema migrations for Warbler.
+
+Each migration is a function that takes a connection, numbered in the
+order it has to run. The schema_version table records which ones a
+database has had, and `upgrade()` runs the rest, each in its own
+transaction:
+
+    flask db-upgrade
+
+Every migration checks before it changes anything. That way they are
+safe on a new database, where migration 1 has already built the current
+schema from the models, and on one made by an older `db.create_all()`
+with no schema_version table.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import func, inspect, select
+
+import counters
+from models import db, Job, USERNAME_PREFIX_INDEX, USERNAME_TRIGRAM_INDEX
+
+schema_version = db.Table(
+    'schema_version',
+    db.Column('version', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('name', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+
+def _index_names(conn, table):
+    return {index['name'] for index in inspect(conn).get_indexes(table)}
+
+
+def initial_schema(conn):
+    """Create any missing tables."""
+
+    db.metadata.create_all(conn)
+
+
+def user_counters(conn):
+    """Add the per-user counters and profile version."""
+
+    existing = {column['name'] for column in inspect(conn).get_columns('users')}
+    missing = [name for name in ['messages_count', 'following_count',
+                                 'followers_count', 'likes_count', 'version']
+               if name not in existing]
+
+    for name in missing:
+        conn.execute(f'ALTER TABLE users ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0')
+
+    if missing:
+        counters.reconcile(conn)
+
+
+def likes_per_user(conn):
+    """Let more than one user like a message (unique per user and message)."""
+
+    unique = {constraint['name']
+              for constraint in inspect(conn).get_unique_constraints('likes')}
+
+    # Tables made before this had message_id itself unique; only Postgres
+    # ever had one of those, SQLite databases are new.
+    if 'likes_message_id_key' in unique:
+        conn.execute('ALTER TABLE likes DROP CONSTRAINT likes_message_id_key')
+
+    if 'likes_user_id_message_id_key' not in unique:
+        conn.execute('ALTER TABLE likes ADD CONSTRAINT likes_user_id_message_id_key '
+                     'UNIQUE (user_id, message_id)')
+
+    if 'ix_likes_message_id' not in _index_names(conn, 'likes'):
+        conn.execute('CREATE INDEX ix_likes_message_id ON likes (message_id)')
+
+
+def hot_path_indexes(conn):
+    """Index the lookups behind the profile, home timeline and following pages."""
+
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_messages_user_timestamp '
+                 'ON messages (user_id, timestamp, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_follows_user_following_id '
+                 'ON follows (user_following_id, user_being_followed_id)')
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(USERNAME_TRIGRAM_INDEX)
+
+
+def job_queue(conn):
+    """Add the background job queue."""
+
+    Job.__table__.create(conn, checkfirst=True)
+
+
+def username_prefix_index(conn):
+    """Index lower(username) for case-insensitive prefix lookups."""
+
+    ddl = USERNAME_PREFIX_INDEX.get(conn.dialect.name)
+    if ddl is not None:
+        conn.execute(ddl)
+
+
+def pending_deletion(conn):
+    """Mark accounts that are waiting to be deleted."""
+
+    existing = {column['name'] for column in inspect(conn).get_columns('users')}
+    if 'deleting' not in existing:
+        conn.execute('ALTER TABLE users ADD COLUMN deleting BOOLEAN NOT NULL DEFAULT FALSE')
+
+
+MIGRATIONS = [
+    (1, initial_schema),
+    (2, user_counters),
+    (3, likes_per_user),
+    (4, hot_path_indexes),
+    (5, job_queue),
+    (6, username_prefix_index),
+    (7, pending_deletion),
+]
+
+
+def current_version(conn):
+    """The newest migration applied to the database (0 for none)."""
+
+    schema_version.create(conn, checkfirst=True)
+    return conn.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def upgrade(engine=None):
+    """Apply every pending migration; returns the versions applied."""
+
+    engine = engine or db.engine
+
+    with engine.begin() as conn:
+        current = current_version(conn)
+
+    applied = []
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(schema_version.insert().values(
+                version=version,
+                name=migration.__doc__,
+                applied_at=datetime.utcnow(),
+            ))
+        applied.append(version)
+
+    return applied
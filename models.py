@@ -2,11 +2,19 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, exists, literal, select
+from sqlalchemy.exc import IntegrityError
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from dbpool import PooledSQLAlchemy
+from passwords import hasher
+from replicas import RoutingSQLAlchemy
+
+
+class WarblerSQLAlchemy(RoutingSQLAlchemy, PooledSQLAlchemy):
+    """Flask-SQLAlchemy with replica routing and a configurable pool."""
+
+
+db = WarblerSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,12 +34,25 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "who does X
+    # follow" (the home timeline and following pages).
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
+    # Each user can like a message once; this also serves lookups by user
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='likes_user_id_message_id_key'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -45,7 +66,7 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        index=True
     )
 
 
@@ -94,6 +115,56 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts of the relationships below, kept up to date by
+    # the routes that change them (see counters.py).
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever the profile details shown next to this user's
+    # messages change, so anything cached from them can be told apart.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the user asks for their account to be deleted. Deleting it
+    # runs as a background job (see jobs.py); until that finishes the
+    # account can't log in or change anything.
+    deleting = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,23 +192,87 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        follow = Follows.query.filter_by(user_following_id=self.id,
+                                         user_being_followed_id=other_user.id)
+        return db.session.query(follow.exists()).scalar()
+
+    def following_ids(self, users):
+        """Which of `users` is this user following? Returns a set of ids.
+
+        Answers for a whole page of users in a single query.
+        """
+
+        ids = [user.id for user in users]
+        if not ids:
+            return set()
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(ids)))
+        return {user_id for (user_id,) in followed}
+
+    def liked_message_ids(self, messages):
+        """Which of `messages` has this user liked? Returns a set of ids.
+
+        Answers for a whole page of messages in a single query.
+        """
+
+        ids = [msg.id for msg in messages]
+        if not ids:
+            return set()
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        liked = (db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == self.id,
+                         Likes.message_id.in_(ids)))
+        return {message_id for (message_id,) in liked}
+
+    def like(self, message_id):
+        """Like a message. Returns False if it was already liked.
+
+        A single INSERT, so liking twice (a double click, or two tabs) is
+        harmless rather than an error.
+        """
+
+        already_liked = exists().where((Likes.user_id == self.id) &
+                                       (Likes.message_id == message_id))
+        row = select([literal(self.id), literal(message_id)]).where(~already_liked)
+
+        try:
+            with db.session.begin_nested():
+                result = db.session.execute(Likes.__table__.insert().from_select(
+                    ['user_id', 'message_id'], row))
+        except IntegrityError:
+            # A concurrent request inserted the same like first
+            return False
+
+        return result.rowcount > 0
+
+    def unlike(self, message_id):
+        """Remove a like. Returns False if the message wasn't liked."""
+
+        removed = (Likes
+                   .query
+                   .filter(Likes.user_id == self.id,
+                           Likes.message_id == message_id)
+                   .delete(synchronize_session=False))
+        return removed > 0
 
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Raises PasswordHasherBusy
+        if the hashing pool is saturated.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -158,18 +293,56 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different work factor than the
+        one configured now, it is transparently re-hashed; the caller must
+        commit to save it.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleting=False).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth, rehashed = hasher.verify(user.password, password)
             if is_auth:
+                if rehashed:
+                    user.password = rehashed
                 return user
 
         return False
 
 
+# Trigram index so username substring searches (see search.py) don't scan
+# the whole table. Postgres only, and only where pg_trgm is available.
+USERNAME_TRIGRAM_INDEX = DDL("""
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+            ON users USING gin (username gin_trgm_ops);
+    END IF;
+END
+$$
+""")
+
+event.listen(User.__table__, 'after_create',
+             USERNAME_TRIGRAM_INDEX.execute_if(dialect='postgresql'))
+
+# Username prefix lookups (autocomplete, see search.py) read one range of
+# this index, already in order. Postgres compares it bytewise ("C") so
+# the range is exactly the usernames starting with the prefix, whatever
+# the database's collation.
+USERNAME_PREFIX_INDEX = {
+    'postgresql': DDL('CREATE INDEX IF NOT EXISTS ix_users_username_lower '
+                      'ON users ((lower(username) COLLATE "C"))'),
+    'sqlite': DDL('CREATE INDEX IF NOT EXISTS ix_users_username_lower '
+                  'ON users (lower(username))'),
+}
+
+for dialect, ddl in USERNAME_PREFIX_INDEX.items():
+    event.listen(User.__table__, 'after_create', ddl.execute_if(dialect=dialect))
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -188,7 +361,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +372,91 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # A user's messages newest first: profiles and the home timeline
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's precomputed home timeline.
+
+    The message timestamp is copied onto the entry so a timeline can be
+    read in order straight off the (user_id, timestamp) index.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+
+class Job(db.Model):
+    """A queued background job (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    # JSON keyword arguments for the job's handler
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    run_after = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # Set once a job has used up its retries; failed jobs stay for a look
+    failed_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_run_after', 'run_after'),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,124 @@
+"""Keyset (cursor) pagination for Warbler message and user lists.
+
+Pages are ordered newest first on (timestamp, id), or on an id alone for
+lists without timestamps, and a cursor names the last row shown. Fetching
+the next page is then an index range scan that costs the same no matter
+how far down the list it is.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort, request
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 100
+
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque, URL-safe cursor for the row at (timestamp, id)."""
+
+    return f"{timestamp.strftime(CURSOR_TIME_FORMAT)}-{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id); ValueError if malformed."""
+
+    timestamp, id = cursor.split('-')
+    return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(id)
+
+
+def cursor_arg():
+    """Read the decoded `before` cursor (or None) from the querystring.
+
+    Responds with a 400 for a cursor that can't be decoded.
+    """
+
+    before = request.args.get('before')
+    if not before:
+        return None
+
+    try:
+        return decode_cursor(before)
+    except ValueError:
+        abort(400)
+
+
+def limit_arg():
+    """Read the page size from the querystring, clamped to MAX_PAGE_SIZE."""
+
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def page_args():
+    """Read (before, limit) from the querystring of the current request.
+
+    Responds with a 400 for a cursor that can't be decoded.
+    """
+
+    return cursor_arg(), limit_arg()
+
+
+def id_page_args():
+    """Read (before, limit) for a list paged by id (see paginate_by_id)."""
+
+    before = request.args.get('before')
+    if before is None:
+        return None, limit_arg()
+
+    try:
+        return int(before), limit_arg()
+    except ValueError:
+        abort(400)
+
+
+def paginate(query, timestamp_col, id_col, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Fetch one page of `query`, newest first, keyed on the given columns.
+
+    `before` is a decoded cursor; only rows strictly older than it are
+    returned. The returned page's `next_cursor` is None on the last page.
+    """
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+
+    items = (query
+             .order_by(timestamp_col.desc(), id_col.desc())
+             .limit(limit + 1)
+             .all())
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return Page(items, next_cursor)
+
+
+def paginate_by_id(query, id_col, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Fetch one page of `query`, highest `id_col` first.
+
+    For lists with no timestamp of their own, like a user's followers,
+    keyed on a column the list's index already holds. `id_col` must equal
+    each item's `id`, which becomes the cursor: the returned page's
+    `next_cursor` is None on the last page.
+    """
+
+    if before is not None:
+        query = query.filter(id_col < before)
+
+    items = query.order_by(id_col.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = items[-1].id
+
+    return Page(items, next_cursor)
@@ -0,0 +1,146 @@
+"""Password hashing for Warbler on a bounded worker pool.
+
+bcrypt is deliberately slow, so hashing and checking run on a small
+dedicated thread pool. bcrypt releases the GIL, so the pool hashes in
+parallel, and its size caps how many CPU cores a burst of logins can take.
+
+The request thread still waits for its job, so this doesn't make a login
+any quicker or free its thread. The point is back-pressure: at most
+`BCRYPT_MAX_PENDING` jobs may be running or queued at once, and past that
+`PasswordHasherBusy` is raised straight away, so the request can be turned
+away cheaply instead of piling up behind the queue.
+
+A login that needs its hash upgraded checks and re-hashes in the same job
+(`verify()`), so a correct password never needs a second place in the
+queue it might not get.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PENDING = 32
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+class PasswordHasher:
+    """Runs bcrypt on a size-limited executor and keeps queue metrics."""
+
+    def __init__(self, log_rounds=DEFAULT_LOG_ROUNDS, workers=DEFAULT_WORKERS,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self._lock = threading.Lock()
+        self._configure(log_rounds, workers, max_pending)
+
+    def _configure(self, log_rounds, workers, max_pending):
+        self.log_rounds = log_rounds
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    def init_app(self, app):
+        """Pick up the pool size and work factor from app config."""
+
+        self._executor.shutdown(wait=True)
+        self._configure(
+            app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS),
+            app.config.get('BCRYPT_WORKERS', DEFAULT_WORKERS),
+            app.config.get('BCRYPT_MAX_PENDING', DEFAULT_MAX_PENDING),
+        )
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+
+        with self._lock:
+            self.pending += 1
+
+        def job():
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.busy_seconds += time.perf_counter() - start
+
+        try:
+            return self._executor.submit(job).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+            self._slots.release()
+
+    def hash(self, password):
+        """Hash `password` at the configured work factor."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password,
+                           self.log_rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the stored bcrypt hash `hashed`?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def verify(self, hashed, password):
+        """Check `password` against `hashed`, re-hashing it if it's outdated.
+
+        Returns (matches, new hash or None); the new hash is only made for
+        a matching password whose hash `needs_rehash()`.
+        """
+
+        log_rounds = self.log_rounds
+
+        def check_and_rehash():
+            if not bcrypt.check_password_hash(hashed, password):
+                return False, None
+            if not self.needs_rehash(hashed):
+                return True, None
+            return True, bcrypt.generate_password_hash(password, log_rounds).decode('UTF-8')
+
+        return self._run(check_and_rehash)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than configured?"""
+
+        # bcrypt hashes look like $2b$<cost>$<salt+digest>
+        try:
+            return int(hashed.split('$')[2]) != self.log_rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self):
+        """Snapshot of pool size, queue depth and throughput counters."""
+
+        with self._lock:
+            return dict(log_rounds=self.log_rounds,
+                        workers=self.workers,
+                        max_pending=self.max_pending,
+                        pending=self.pending,
+                        completed=self.completed,
+                        rejected=self.rejected,
+                        busy_seconds=round(self.busy_seconds, 3))
+
+
+hasher = PasswordHasher()
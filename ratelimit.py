@@ -0,0 +1,265 @@
+"""Token-bucket rate limiting for Warbler's expensive routes.
+
+Logging in and signing up cost a bcrypt hash and posting costs writes,
+so views marked `@limit(name)` are throttled on submission (POST). Each
+client IP and each user gets its own bucket per limit. A bucket holds up
+to the limit's allowance of tokens and refills steadily over its period
+(RATELIMIT_LOGIN='10/minute' allows a burst of 10, then one every six
+seconds). A "user" is the logged-in user, or the username being logged
+into or signed up as.
+
+The check runs before any other request handling (bar the request
+metrics), so a client over its limit gets a small 429 response without
+its form being validated or the database being touched. A request only
+takes tokens when every one of its buckets has one to give, so being
+turned away by one bucket doesn't drain the others.
+
+Clients are told apart by `request.remote_addr`. Behind a reverse proxy
+or load balancer that is the proxy's address, so wrap the app in
+werkzeug's ProxyFix (configured for the number of proxies in front of
+it) or every client will share one bucket.
+
+Buckets live in a bounded in-process table by default. With
+CACHE_REDIS_URL set they are kept in Redis instead, so every worker
+process draws from the same buckets.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request, session
+
+DEFAULT_LIMITS = {
+    'login': '10/minute',
+    'signup': '5/minute',
+    'post': '30/minute',
+}
+DEFAULT_TABLE_SIZE = 10000
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+LIMITED_METHODS = {'POST'}
+
+buckets = None
+
+
+def limit(name):
+    """Throttle submissions to the decorated view under limit `name`."""
+
+    def mark(view):
+        view.rate_limit = name
+        return view
+
+    return mark
+
+
+def parse_rate(rate):
+    """Turn '10/minute' into (capacity, tokens added per second)."""
+
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period.strip()]
+
+
+class TokenBuckets:
+    """In-process token buckets, keeping at most `max_size` of them.
+
+    Each bucket is just (tokens, last refill time). When the table is
+    full the least recently used bucket is dropped, which only ever lets
+    its owner start again with a full bucket.
+    """
+
+    def __init__(self, max_size=DEFAULT_TABLE_SIZE):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, keys, capacity, refill_rate, now=None):
+        """Take a token from each of the buckets `keys`, if they all have one.
+
+        Returns 0 if they did, else how many seconds until they all do
+        (and takes nothing).
+        """
+
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            levels = {}
+            for key in keys:
+                tokens, updated = self._buckets.pop(key, (capacity, now))
+                levels[key] = min(capacity, tokens + (now - updated) * refill_rate)
+
+            missing = [1 - tokens for tokens in levels.values() if tokens < 1]
+            wait = max(missing) / refill_rate if missing else 0
+
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+
+            for key, tokens in levels.items():
+                self._buckets[key] = (tokens - (0 if wait else 1), now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+
+            return wait
+
+    def clear(self):
+        """Refill every bucket (by forgetting them all)."""
+
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        """Snapshot of table size and allowed/limited counters."""
+
+        with self._lock:
+            return dict(buckets=len(self._buckets),
+                        max_size=self.max_size,
+                        allowed=self.allowed,
+                        limited=self.limited)
+
+
+# Refill the buckets KEYS and, if they all have a token, take one from
+# each, atomically. ARGV holds capacity, refill rate and the current time.
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+
+for i, key in ipairs(KEYS) do
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class RedisTokenBuckets:
+    """Token buckets shared between processes through a Redis server.
+
+    Buckets expire once they would have refilled, so Redis only holds
+    those of recently active clients.
+    """
+
+    def __init__(self, url, prefix='ratelimit'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, keys, capacity, refill_rate, now=None):
+        """Take a token from each of the buckets `keys`, if they all have one.
+
+        Returns 0 if they did, else how many seconds until they all do
+        (and takes nothing).
+        """
+
+        now = time.time() if now is None else now
+        wait = float(self._take(keys=[f"{self.prefix}:{key}" for key in keys],
+                                args=[capacity, refill_rate, now]))
+
+        if wait:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def clear(self):
+        """Refill every bucket (by forgetting them all)."""
+
+        for key in self.client.scan_iter(f"{self.prefix}:*"):
+            self.client.delete(key)
+
+    def stats(self):
+        """Allowed/limited counters for this process."""
+
+        return dict(allowed=self.allowed, limited=self.limited)
+
+
+def _check_limit():
+    """Turn away a submission to a limited view whose buckets are empty."""
+
+    if request.method not in LIMITED_METHODS:
+        return None
+
+    view = current_app.view_functions.get(request.endpoint)
+    name = getattr(view, 'rate_limit', None)
+    if name is None:
+        return None
+
+    capacity, refill_rate = parse_rate(current_app.config['RATELIMITS'][name])
+
+    user = session.get(current_app.config['RATELIMIT_USER_KEY'])
+    if user is None:
+        user = request.form.get('username', '').lower() or None
+
+    keys = [f"{name}:ip:{request.remote_addr}"]
+    if user is not None:
+        keys.append(f"{name}:user:{user}")
+
+    wait = buckets.take(keys, capacity, refill_rate)
+    if not wait:
+        return None
+
+    return Response("Too many requests. Please try again in a moment.\n",
+                    status=429,
+                    mimetype='text/plain',
+                    headers={'Retry-After': str(math.ceil(wait)),
+                             'Cache-Control': 'no-store'})
+
+
+def init_app(app, user_key):
+    """Throttle `app`'s limited views.
+
+    `user_key` is the session key holding the logged-in user's id. Call
+    this after instrumentation.init_app (so turned away requests still
+    show in /metrics) and before registering anything else that runs
+    before requests, so an over-limit request does no other work.
+    """
+
+    global buckets
+
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(app.config.get('RATELIMITS') or {})
+    app.config['RATELIMITS'] = limits
+    app.config['RATELIMIT_USER_KEY'] = user_key
+
+    if not app.config.get('RATELIMIT_ENABLED', True):
+        return
+
+    redis_url = app.config.get('CACHE_REDIS_URL')
+    if redis_url:
+        buckets = RedisTokenBuckets(redis_url)
+    else:
+        buckets = TokenBuckets(app.config.get('RATELIMIT_TABLE_SIZE',
+                                              DEFAULT_TABLE_SIZE))
+
+    app.before_request(_check_limit)
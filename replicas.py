@@ -0,0 +1,109 @@
+"""Read-replica routing for Warbler's database session.
+
+With REPLICA_DATABASE_URIS configured, each replica becomes a
+Flask-SQLAlchemy bind ('replica_0', 'replica_1', ...). Queries made by
+views marked `@read_only` go to one of them, picked per request;
+everything else, and any write or flush wherever it happens, goes to the
+primary (SQLALCHEMY_DATABASE_URI).
+
+Replicas lag the primary a little, so after a visitor makes a request
+that writes (anything but GET/HEAD), their reads stay on the primary for
+REPLICA_STICKY_SECONDS. That way they always see their own changes.
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import UpdateBase
+
+DEFAULT_STICKY_SECONDS = 5
+
+# Session key holding when this visitor's reads may go back to a replica
+STICKY_KEY = '_primary_until'
+
+READ_METHODS = {'GET', 'HEAD'}
+
+
+def read_only(view):
+    """Mark `view` as only reading, so its queries may use a replica."""
+
+    view.read_only = True
+    return view
+
+
+def replica_keys(app):
+    """The bind keys of `app`'s replicas."""
+
+    uris = app.config.get('REPLICA_DATABASE_URIS') or []
+    return [f'replica_{i}' for i in range(len(uris))]
+
+
+def _replica_allowed():
+    """May this request's reads go to a replica?"""
+
+    if not has_request_context() or request.method not in READ_METHODS:
+        return False
+
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, 'read_only', False):
+        return False
+
+    return session.get(STICKY_KEY, 0) < time.time()
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends read-only views' queries to a replica."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        keys = replica_keys(self.app)
+
+        if (keys
+                and not self._flushing
+                and not isinstance(clause, UpdateBase)
+                and _replica_allowed()):
+            # One replica per request, so its reads are consistent
+            if 'replica' not in g:
+                g.replica = random.choice(keys)
+            return self.db.get_engine(self.app, bind=g.replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that know about replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _stick_to_primary(response):
+    """After a write, keep this visitor's reads on the primary for a while."""
+
+    if replica_keys(current_app) and request.method not in READ_METHODS:
+        window = current_app.config.get('REPLICA_STICKY_SECONDS',
+                                        DEFAULT_STICKY_SECONDS)
+        session[STICKY_KEY] = time.time() + window
+
+    return response
+
+
+def init_app(app):
+    """Register REPLICA_DATABASE_URIS as binds on `app`.
+
+    Call this before the app's database is set up.
+    """
+
+    uris = app.config.get('REPLICA_DATABASE_URIS') or []
+    if uris:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds.update(zip(replica_keys(app), uris))
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    app.after_request(_stick_to_primary)
@@ -0,0 +1,123 @@
+"""User search for Warbler.
+
+Matches are ranked with usernames starting with the query first, then
+shorter (closer) usernames, then alphabetically. On Postgres a trigram
+index (see models.py) finds the substring matches, though ranking still
+sorts all of them; on SQLite a search reads the whole users table.
+
+Autocomplete only wants prefixes, so it reads the range of the
+lower(username) index between the prefix and the next string after all
+its extensions, in index order, and stops after `limit` rows.
+"""
+
+import sys
+
+from sqlalchemy import func
+
+from models import db, User
+from pagination import Page
+
+PER_PAGE = 24
+MAX_PAGE = 50
+AUTOCOMPLETE_LIMIT = 10
+
+# Code points that can't appear in a string the database will take
+SURROGATES = (0xD800, 0xDFFF)
+
+
+def _escape_like(text):
+    """Escape LIKE wildcards so `text` only ever matches literally."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _first_page(query, limit):
+    """Fetch `limit` rows plus one, to find out if there's a next page."""
+
+    items = query.limit(limit + 1).all()
+    return items[:limit], len(items) > limit
+
+
+def browse(after=None, per_page=PER_PAGE):
+    """List users alphabetically, starting after username `after`."""
+
+    query = User.query.order_by(User.username)
+    if after:
+        query = query.filter(User.username > after)
+
+    users, more = _first_page(query, per_page)
+    return Page(users, users[-1].username if more else None)
+
+
+def search(q, page=1, per_page=PER_PAGE):
+    """Rank users whose username contains `q`; `page` counts from 1.
+
+    Deep pages of a ranked search are rarely useful, so they stop at
+    MAX_PAGE rather than paying for ever-growing offsets.
+    """
+
+    page = max(1, min(page, MAX_PAGE))
+    escaped = _escape_like(q)
+
+    query = (User
+             .query
+             .filter(User.username.ilike(f'%{escaped}%', escape='\\'))
+             .order_by(User.username.ilike(f'{escaped}%', escape='\\').desc(),
+                       func.length(User.username),
+                       User.username)
+             .offset((page - 1) * per_page))
+
+    users, more = _first_page(query, per_page)
+    return Page(users, page + 1 if more and page < MAX_PAGE else None)
+
+
+def _lowered_username():
+    """lower(username), compared the way ix_users_username_lower is ordered."""
+
+    lowered = func.lower(User.username)
+    if db.session.get_bind(User.__mapper__).dialect.name == 'postgresql':
+        lowered = lowered.collate('C')
+    return lowered
+
+
+def _after_prefix(prefix):
+    """The first string after every string starting with `prefix`.
+
+    That's `prefix` with its last character incremented; a character that
+    can't be (the last code point) is dropped and the one before it
+    incremented instead. None if there's no such string.
+    """
+
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if SURROGATES[0] <= code <= SURROGATES[1]:
+            code = SURROGATES[1] + 1
+        if code <= sys.maxunicode:
+            return prefix[:-1] + chr(code)
+        prefix = prefix[:-1]
+
+    return None
+
+
+def autocomplete(q, limit=AUTOCOMPLETE_LIMIT):
+    """Usernames starting with `q` (ignoring case), alphabetically, for type-ahead."""
+
+    # No username has a NUL in it, and Postgres won't take one
+    if '\x00' in q:
+        return []
+
+    prefix = q.lower()
+    lowered = _lowered_username()
+
+    query = User.query.filter(lowered >= prefix)
+    after = _after_prefix(prefix)
+    if after is not None:
+        query = query.filter(lowered < after)
+
+    return (query
+            .order_by(lowered)
+            .limit(limit)
+            .all())
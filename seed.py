@@ -1,20 +1,274 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
+Each CSV is streamed into its table a chunk at a time, committing after
+every chunk, so memory use stays flat however large the files are. On
+Postgres the chunks go through COPY FROM STDIN; elsewhere they're batched
+executemany inserts.
+
+Secondary indexes and foreign keys are dropped for the duration of the
+load and rebuilt at the end, which is much faster than maintaining them
+row by row.
+
+Run it from the project root:
+
+    python seed.py [--data-dir generator] [--chunk-size 10000]
+
+(or `%run seed.py` in ipython).
+"""
+
+import argparse
+import csv
+import io
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+from app import app, db
 from models import User, Message, Follows
+import counters
+import migrations
+import timeline
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Loaded in this order, so foreign keys hold once they're restored
+SEED_FILES = [
+    (User, 'users.csv'),
+    (Message, 'messages.csv'),
+    (Follows, 'follows.csv'),
+]
+
+
+def report(message):
+    """Progress goes to stderr, so stdout stays clean for piping."""
+
+    print(message, file=sys.stderr, flush=True)
+
+
+def chunked(rows, size):
+    """Split an iterable of rows into lists of at most `size` rows."""
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+##############################################################################
+# Deferring indexes and constraints
+
+
+def _postgres_deferrables(conn, table):
+    """Statements to drop and restore `table`'s secondary indexes and FKs."""
+
+    indexes = conn.execute("""
+        SELECT indexname, indexdef
+        FROM pg_indexes
+        WHERE tablename = %s
+          AND indexname NOT IN (SELECT conname FROM pg_constraint)
+    """, (table,)).fetchall()
+
+    foreign_keys = conn.execute("""
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+    """, (table,)).fetchall()
+
+    drops = ([f'DROP INDEX "{name}"' for name, _ in indexes] +
+             [f'ALTER TABLE "{table}" DROP CONSTRAINT "{name}"'
+              for name, _ in foreign_keys])
+    restores = ([definition for _, definition in indexes] +
+                [f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition}'
+                 for name, definition in foreign_keys])
+
+    return drops, restores
+
+
+def _sqlite_deferrables(conn, table):
+    """Statements to drop and restore `table`'s secondary indexes.
+
+    SQLite can't add foreign keys to an existing table (and doesn't
+    enforce them by default), so those are left alone.
+    """
+
+    indexes = conn.execute("""
+        SELECT name, sql
+        FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL
+    """, (table,)).fetchall()
+
+    return ([f'DROP INDEX "{name}"' for name, _ in indexes],
+            [definition for _, definition in indexes])
+
+
+@contextmanager
+def deferred_indexes(tables):
+    """Drop secondary indexes (and FKs, on Postgres) on `tables` while loading.
+
+    They are recreated afterwards even if the load fails, so a bad CSV
+    never leaves the database without them.
+    """
+
+    find = {'postgresql': _postgres_deferrables,
+            'sqlite': _sqlite_deferrables}.get(db.engine.dialect.name)
+
+    if find is None:
+        yield
+        return
+
+    drops, restores = [], []
+    with db.engine.begin() as conn:
+        for table in tables:
+            table_drops, table_restores = find(conn, table)
+            drops += table_drops
+            restores += table_restores
+
+        for statement in drops:
+            conn.execute(statement)
+
+    try:
+        yield
+    finally:
+        start = time.perf_counter()
+        with db.engine.begin() as conn:
+            for statement in restores:
+                conn.execute(statement)
+
+        report(f"rebuilt {len(restores)} indexes/constraints "
+               f"in {time.perf_counter() - start:.1f}s")
+
+
+##############################################################################
+# Loading
+
+
+def _copy_chunk(raw_conn, table, columns, chunk):
+    """COPY one chunk of CSV rows into `table` and commit (Postgres)."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(chunk)
+    buffer.seek(0)
+
+    cursor = raw_conn.cursor()
+    cursor.copy_expert(
+        f'COPY "{table}" ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)',
+        buffer)
+    raw_conn.commit()
+
+
+def _insert_chunk(model, columns, chunk):
+    """Insert one chunk of CSV rows with executemany and commit."""
+
+    table = model.__table__
+    datetimes = {name for name in columns
+                 if isinstance(table.c[name].type, db.DateTime)}
+
+    rows = []
+    for values in chunk:
+        row = dict(zip(columns, values))
+        for name in datetimes:
+            row[name] = datetime.fromisoformat(row[name])
+        rows.append(row)
+
+    with db.engine.begin() as conn:
+        conn.execute(table.insert(), rows)
+
+
+def load_csv(model, path, chunk_size):
+    """Stream the CSV at `path` into `model`'s table; returns the row count."""
+
+    table = model.__tablename__
+    use_copy = db.engine.dialect.name == 'postgresql'
+    raw_conn = db.engine.raw_connection() if use_copy else None
+
+    start = time.perf_counter()
+    loaded = 0
+
+    try:
+        with open(path, newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            columns = next(reader)
+
+            for chunk in chunked(reader, chunk_size):
+                if use_copy:
+                    _copy_chunk(raw_conn, table, columns, chunk)
+                else:
+                    _insert_chunk(model, columns, chunk)
+
+                loaded += len(chunk)
+                elapsed = time.perf_counter() - start
+                report(f"{table}: {loaded:,} rows "
+                       f"({loaded / elapsed:,.0f} rows/s)")
+    finally:
+        if raw_conn is not None:
+            raw_conn.close()
+
+    return loaded
+
+
+def reset_sequences(tables):
+    """Point each serial id sequence past the highest id loaded (Postgres)."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    with db.engine.begin() as conn:
+        for table in tables:
+            conn.execute(f"""
+                SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                              COALESCE(MAX(id), 1),
+                              MAX(id) IS NOT NULL)
+                FROM "{table}"
+            """)
+
+
+def seed(data_dir='generator', chunk_size=DEFAULT_CHUNK_SIZE):
+    """Recreate the schema and load every seed CSV from `data_dir`."""
+
+    db.drop_all()
+    migrations.upgrade()
+
+    tables = [model.__tablename__ for model, _ in SEED_FILES]
+    start = time.perf_counter()
+    total = 0
+
+    with deferred_indexes(tables):
+        for model, filename in SEED_FILES:
+            total += load_csv(model, f'{data_dir}/{filename}', chunk_size)
+
+    # The identity columns that have serial sequences
+    reset_sequences(['users', 'messages'])
+
+    # The loads above bypass the routes that maintain the stat counters
+    counters.reconcile()
+    db.session.commit()
+
+    if timeline.is_enabled():
+        for (user_id,) in db.session.query(User.id).order_by(User.id):
+            timeline.rebuild(user_id)
+            db.session.commit()
 
+    elapsed = time.perf_counter() - start
+    report(f"loaded {total:,} rows in {elapsed:.1f}s "
+           f"({total / elapsed:,.0f} rows/s)")
 
-db.drop_all()
-db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory holding users.csv, messages.csv "
+                             "and follows.csv")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows per COPY/insert batch and commit")
+    args = parser.parse_args(argv)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    with app.app_context():
+        seed(args.data_dir, args.chunk_size)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Streaming NDJSON exports of Warbler messages.
+
+A user's whole message history (or home timeline) can be far bigger than
+any page, so these responses are generated a batch at a time from a
+server-side cursor: each line is one message as JSON, newest first, and
+memory use stays the same however many messages there are.
+
+A `limit` is checked before the response starts, since once the first
+line has gone out the status can no longer be changed.
+"""
+
+import json
+
+from flask import Response, abort, request, stream_with_context
+from sqlalchemy import select, tuple_
+
+from models import db, User, Message
+
+BATCH_SIZE = 1000
+MAX_LIMIT = 10000
+
+
+def limit_arg():
+    """Read the optional 'limit' from the querystring, clamped to MAX_LIMIT.
+
+    None (no limit) when it's absent; responds with a 400 for anything
+    but a positive integer.
+    """
+
+    limit = request.args.get('limit')
+    if limit is None:
+        return None
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+
+    if limit <= 0:
+        abort(400)
+
+    return min(limit, MAX_LIMIT)
+
+
+def messages_query(where, before=None, limit=None):
+    """Select the messages matching `where`, newest first, for streaming.
+
+    `before` is a decoded pagination cursor; only older messages are
+    included. Rows carry their author's username.
+    """
+
+    query = (select([Message.id,
+                     Message.text,
+                     Message.timestamp,
+                     Message.user_id,
+                     User.username])
+             .select_from(Message.__table__.join(User.__table__))
+             .where(where))
+
+    if before:
+        query = query.where(tuple_(Message.timestamp, Message.id) < tuple_(*before))
+
+    query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+    if limit:
+        query = query.limit(limit)
+
+    # A server-side cursor on Postgres, so rows arrive as they're read
+    return query.execution_options(stream_results=True, max_row_buffer=BATCH_SIZE)
+
+
+def ndjson_response(query):
+    """Stream the rows of `query` (from messages_query) as NDJSON."""
+
+    def generate():
+        result = db.session.execute(query)
+        try:
+            while True:
+                rows = result.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+
+                yield ''.join(json.dumps(dict(id=row.id,
+                                              text=row.text,
+                                              timestamp=row.timestamp.isoformat(),
+                                              user_id=row.user_id,
+                                              username=row.username)) + '\n'
+                              for row in rows)
+        finally:
+            result.close()
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
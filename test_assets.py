@@ -0,0 +1,98 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import re
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import assets
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class AssetBuildTestCase(TestCase):
+    """Test fingerprinting, precompressing and serving static files."""
+
+    def setUp(self):
+        self.build_dir = tempfile.TemporaryDirectory()
+        self.assets_dir = app.config['ASSETS_DIR']
+        app.config['ASSETS_DIR'] = self.build_dir.name
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_DIR'] = self.assets_dir
+        assets.manifest = assets.load_manifest(app)
+        self.build_dir.cleanup()
+
+    def stylesheet_url(self):
+        html = self.client.get('/login').get_data(as_text=True)
+        return re.search(r'href="([^"]*style[^"]*\.css)"', html).group(1)
+
+    def test_unbuilt_assets_come_from_static(self):
+        """Without a build, do pages link to /static as before?"""
+
+        assets.manifest = {}
+        self.assertEqual(self.stylesheet_url(), '/static/stylesheets/style.css')
+
+    def test_build_and_serve(self):
+        """Are built assets fingerprinted, compressed and served immutable?"""
+
+        built = assets.build(app)
+
+        css_url = self.stylesheet_url()
+        self.assertRegex(css_url, r'^/assets/stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertEqual(css_url, f"/assets/{built['stylesheets/style.css']}")
+
+        resp = self.client.get(css_url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+        # stylesheets point at the fingerprinted images
+        css = resp.get_data(as_text=True)
+        self.assertIn(f"/assets/{built['images/nav-bg.png']}", css)
+        self.assertNotIn('/static/', css)
+
+        resp = self.client.get(css_url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data).decode(), css)
+
+        if brotli is not None:
+            resp = self.client.get(css_url, headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(resp.data).decode(), css)
+
+        # images are already compressed, so they're served as they are
+        resp = self.client.get(f"/assets/{built['images/nav-bg.png']}",
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+        self.assertEqual(resp.mimetype, 'image/png')
+
+    def test_names_follow_content(self):
+        """Does the same content always build to the same name?"""
+
+        first = assets.build(app)
+        second = assets.build(app)
+        self.assertEqual(first, second)
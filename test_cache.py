@@ -0,0 +1,49 @@
+"""In-process cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase
+
+from cache import LRUCache
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the bounded in-process cache."""
+
+    def test_get_and_set(self):
+        """Does the cache return what was set, and None for what wasn't?"""
+
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        """Is the least recently used entry evicted when the cache is full?"""
+
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiry_and_delete(self):
+        """Do expired and deleted entries stop being returned?"""
+
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1, ttl=-1)
+        cache.set('b', 2)
+        cache.delete('b')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
@@ -0,0 +1,41 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import csv
+import os
+import sys
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+# The generator is a script directory, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'generator'))
+
+import create_csvs
+from helpers import get_random_datetime
+
+
+class GeneratorTestCase(TestCase):
+    """Test generating reproducible CSVs."""
+
+    def test_leap_day(self):
+        """Can the generator run with --now on Feb 29?"""
+
+        now = datetime(2024, 2, 29, 12)
+
+        for _ in range(100):
+            timestamp = get_random_datetime(now=now)
+            self.assertGreaterEqual(timestamp, datetime(2022, 2, 28, 12))
+            self.assertLessEqual(timestamp, now)
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            create_csvs.main(['--users', '5', '--messages', '10', '--follows', '5',
+                              '--now', '2024-02-29T12:00:00', '--out-dir', out_dir])
+
+            with open(os.path.join(out_dir, 'messages.csv')) as file:
+                self.assertEqual(len(list(csv.DictReader(file))), 10)
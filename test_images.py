@@ -0,0 +1,269 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import os
+import socket
+import tempfile
+import threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from unittest import TestCase, mock, skipUnless
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import images
+import usercache
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+with open(os.path.join(app.static_folder, 'images', 'default-pic.png'), 'rb') as f:
+    PNG = f.read()
+
+
+class OriginHandler(SimpleHTTPRequestHandler):
+    """Stand-in image host: serves static/images, counting requests."""
+
+    requests = 0
+    host = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=os.path.join(app.static_folder, 'images'),
+                         **kwargs)
+
+    def do_GET(self):
+        OriginHandler.requests += 1
+        OriginHandler.host = self.headers['Host']
+
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/default-pic.png')
+            self.end_headers()
+            return
+
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test fetching, resizing, serving and evicting images."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.origin = HTTPServer(('127.0.0.1', 0), OriginHandler)
+        threading.Thread(target=cls.origin.serve_forever, daemon=True).start()
+        cls.origin_url = f'http://127.0.0.1:{cls.origin.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.origin.shutdown()
+        cls.origin.server_close()
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir.name
+        # the stand-in origin is on localhost
+        app.config['IMAGE_FETCH_ALLOW_PRIVATE'] = True
+        OriginHandler.requests = 0
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['IMAGE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+        app.config['IMAGE_FETCH_ALLOW_PRIVATE'] = False
+        self.cache_dir.cleanup()
+
+    def proxy_url(self, url, variant):
+        with app.test_request_context():
+            return images.image_url(url, variant)
+
+    def test_fetches_once_and_serves_immutable(self):
+        """Is a remote image fetched once, then served from a hashed file?"""
+
+        url = self.proxy_url(f'{self.origin_url}/default-pic.png', 'timeline')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 302)
+        file_url = resp.location
+        self.assertIn('/images/files/', file_url)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.location, file_url)
+        self.assertEqual(OriginHandler.requests, 1)
+
+        resp = self.client.get(file_url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        if Image is not None:
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (48, 48))
+
+    def test_only_signed_urls(self):
+        """Are tokens the app didn't sign refused?"""
+
+        self.assertEqual(self.client.get('/images/timeline/not-a-token').status_code, 404)
+        self.assertEqual(OriginHandler.requests, 0)
+
+    def test_private_addresses_refused(self):
+        """Are internal addresses refused, even when redirected to?"""
+
+        app.config['IMAGE_FETCH_ALLOW_PRIVATE'] = False
+
+        resp = self.client.get(self.proxy_url(f'{self.origin_url}/default-pic.png', 'card'))
+        self.assertEqual(resp.status_code, 302)
+        self.assertNotIn('/images/files/', resp.location)
+        self.assertEqual(OriginHandler.requests, 0)
+
+        # a "public" first hop may not redirect somewhere private
+        with mock.patch.object(images, 'is_public_address', side_effect=[True, False]):
+            resp = self.client.get(self.proxy_url(f'{self.origin_url}/redirect', 'card'))
+        self.assertNotIn('/images/files/', resp.location)
+        self.assertEqual(OriginHandler.requests, 1)
+
+        resp = self.client.get(self.proxy_url('file:///etc/passwd', 'card'))
+        self.assertEqual(resp.status_code, 404)
+
+    def resolve_to_origin(self, host, port, *args, **kwargs):
+        """getaddrinfo, with images.example.com pointing at the stand-in origin."""
+
+        if host == 'images.example.com':
+            host = '127.0.0.1'
+        return self.getaddrinfo(host, port, *args, **kwargs)
+
+    def test_hostnames_vetted_before_connecting(self):
+        """Is a name resolving to an internal address refused before connecting?"""
+
+        self.getaddrinfo = socket.getaddrinfo
+        url = f'http://images.example.com:{self.origin.server_port}/default-pic.png'
+
+        app.config['IMAGE_FETCH_ALLOW_PRIVATE'] = False
+        with mock.patch.object(images.socket, 'getaddrinfo', self.resolve_to_origin), \
+                mock.patch.object(images.socket, 'socket', wraps=socket.socket) as sockets:
+            resp = self.client.get(self.proxy_url(url, 'card'))
+        self.assertEqual(resp.location, url)
+        self.assertEqual(sockets.call_count, 0)
+
+        # once allowed, the vetted address is used but the name is still sent
+        app.config['IMAGE_FETCH_ALLOW_PRIVATE'] = True
+        with mock.patch.object(images.socket, 'getaddrinfo', self.resolve_to_origin):
+            resp = self.client.get(self.proxy_url(url, 'card'))
+        self.assertIn('/images/files/', resp.location)
+        self.assertEqual(OriginHandler.requests, 1)
+        self.assertEqual(OriginHandler.host,
+                         f'images.example.com:{self.origin.server_port}')
+
+    def test_unreachable_origin(self):
+        """Does an image that can't be fetched send the browser to its origin?"""
+
+        missing = f'{self.origin_url}/missing.png'
+        resp = self.client.get(self.proxy_url(missing, 'card'))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, missing)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+    def test_eviction(self):
+        """Is the cache directory kept under its size limit, oldest out first?"""
+
+        first = self.proxy_url('/static/images/default-pic.png', 'header')
+        second = self.proxy_url('/static/images/warbler-logo.png', 'header')
+
+        old = self.client.get(first).location.rsplit('/', 1)[1]
+        os.utime(os.path.join(self.cache_dir.name, 'files', old), (0, 0))
+
+        app.config['IMAGE_CACHE_MAX_BYTES'] = 1
+        self.client.get(second)
+
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir.name, 'files', old)))
+
+        # a store that leaves the cache under its limit doesn't scan it
+        app.config['IMAGE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+        with mock.patch.object(images, '_cache_entries',
+                               wraps=images._cache_entries) as scan:
+            self.client.get(self.proxy_url('/static/images/nav-bg.png', 'header'))
+        scan.assert_not_called()
+
+        # an evicted image is stored again when it's next asked for
+        resp = self.client.get(first)
+        self.assertEqual(self.client.get(resp.location).status_code, 200)
+
+    @skipUnless(Image, "needs Pillow")
+    def test_variants_are_resized(self):
+        """Is each variant cropped to its own size?"""
+
+        for variant, size in images.VARIANTS.items():
+            resp = self.client.get(self.proxy_url('/static/images/warbler-hero.jpg', variant))
+            resp = self.client.get(resp.location)
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, size)
+
+    def test_profile_upload(self):
+        """Can users upload their avatar instead of giving a URL?"""
+
+        User.query.delete()
+        Message.query.delete()
+        User.signup(username='uploader',
+                    email='uploader@test.com',
+                    password='uploader',
+                    image_url=None).id = 666
+        db.session.commit()
+        usercache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 666
+
+            resp = c.post('/users/profile',
+                          content_type='multipart/form-data',
+                          data={'username': 'uploader',
+                                'email': 'uploader@test.com',
+                                'password': 'uploader',
+                                'image_file': (io.BytesIO(PNG), 'me.png')})
+            self.assertEqual(resp.status_code, 302)
+
+        image_url = User.query.get(666).image_url
+        self.assertTrue(image_url.startswith('/images/uploads/'))
+
+        resp = self.client.get(image_url)
+        self.assertEqual(resp.data, PNG)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        resp = self.client.get(self.proxy_url(image_url, 'timeline'))
+        self.assertEqual(self.client.get(resp.location).status_code, 200)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 666
+
+            resp = c.post('/users/profile',
+                          data={'username': 'uploader',
+                                'email': 'uploader@test.com',
+                                'password': 'uploader',
+                                'image_url': 'http://169.254.169.254/latest/meta-data'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Images must be on a public host.', str(resp.data))
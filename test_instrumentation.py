@@ -0,0 +1,167 @@
+"""Request instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase, mock
+
+from flask import Flask, g
+from sqlalchemy.engine.url import make_url
+
+from dbpool import TimedNullPool
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import instrumentation
+from instrumentation import metrics
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+METRICS_TOKEN = 'sekrit'
+AUTHORIZED = {'Authorization': f'Bearer {METRICS_TOKEN}'}
+
+
+class InstrumentationTestCase(TestCase):
+    """Test per-request metrics."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        user = User.signup(username='test1',
+                           email='test1@test.com',
+                           password='test1',
+                           image_url=None)
+        user.id = 666
+        db.session.commit()
+
+        metrics.reset()
+        app.config['METRICS_TOKEN'] = METRICS_TOKEN
+        self.client = app.test_client()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['METRICS_TOKEN'] = None
+        app.config['METRICS_ALLOW_LOCAL'] = False
+        return res
+
+    def test_records_queries_per_endpoint(self):
+        """Are queries, db time and render time recorded for each endpoint?"""
+
+        with self.client as c:
+            c.get('/users/666')
+            c.get('/users/666')
+
+            resp = c.get('/metrics', headers=AUTHORIZED)
+            self.assertEqual(resp.status_code, 200)
+
+            stats = resp.get_json()['endpoints']['users_show']
+            self.assertEqual(stats['requests'], 2)
+            self.assertGreater(stats['avg_queries'], 0)
+            self.assertGreater(stats['avg_render_ms'], 0)
+            self.assertIn('SELECT', stats['slowest_statement'])
+            self.assertIn('bcrypt', resp.get_json())
+
+    def test_nested_render_time(self):
+        """Does a template rendered inside another count towards the outer render time?"""
+
+        with app.test_request_context():
+            instrumentation._start_request()
+
+            with mock.patch.object(instrumentation.time, 'perf_counter',
+                                   side_effect=[0.0, 10.0]):
+                instrumentation._before_render(app, None, {})
+                # e.g. a message fragment
+                instrumentation._before_render(app, None, {})
+                instrumentation._after_render(app, None, {})
+                instrumentation._after_render(app, None, {})
+
+            self.assertEqual(g.request_stats['render_seconds'], 10.0)
+
+    def test_prometheus_format(self):
+        """Can metrics be scraped in the Prometheus text format?"""
+
+        with self.client as c:
+            c.get('/users/666')
+            resp = c.get('/metrics?format=prometheus', headers=AUTHORIZED)
+
+            self.assertIn('warbler_requests_total{endpoint="users_show"} 1',
+                          resp.data.decode())
+
+    def test_metrics_token(self):
+        """Is /metrics closed to requests without the configured token?"""
+
+        with self.client as c:
+            self.assertEqual(c.get('/metrics').status_code, 404)
+
+            resp = c.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.get('/metrics', headers=AUTHORIZED)
+            self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_closed_without_token(self):
+        """With no token configured, is /metrics closed even to localhost?"""
+
+        app.config['METRICS_TOKEN'] = None
+
+        with self.client as c:
+            self.assertEqual(c.get('/metrics').status_code, 404)
+
+            # unless local access is asked for
+            app.config['METRICS_ALLOW_LOCAL'] = True
+            self.assertEqual(c.get('/metrics').status_code, 200)
+            self.assertEqual(
+                c.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.9'}).status_code,
+                404)
+
+
+class PoolStatsTestCase(TestCase):
+    """Test connection pool settings and statistics."""
+
+    def test_pool_stats_in_metrics(self):
+        """Are pool checkouts and wait times reported alongside request metrics?"""
+
+        app.config['METRICS_TOKEN'] = METRICS_TOKEN
+        self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN', None)
+
+        client = app.test_client()
+        client.get('/users/666')
+
+        stats = client.get('/metrics', headers=AUTHORIZED).json['pool']
+        self.assertGreater(stats['checkouts'], 0)
+        self.assertEqual(stats['size'], app.config['DATABASE_POOL_SIZE'])
+        self.assertIn('max_wait_ms', stats)
+        self.assertIn('timeouts', stats)
+
+    def test_pgbouncer_mode(self):
+        """Does pgbouncer mode leave pooling to pgbouncer?"""
+
+        bouncer_app = Flask(__name__)
+        bouncer_app.config['SQLALCHEMY_NATIVE_UNICODE'] = None
+        bouncer_app.config['DATABASE_PGBOUNCER'] = True
+
+        options = {}
+        db.apply_driver_hacks(bouncer_app, make_url('postgresql:///warbler'), options)
+        self.assertIs(options['poolclass'], TimedNullPool)
+        self.assertNotIn('pool_size', options)
@@ -0,0 +1,160 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import usercache
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JobQueueTestCase(TestCase):
+    """Test queued jobs and their handlers."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Job.query.delete()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        usercache.clear()
+        self.client = app.test_client()
+
+        self.author = User.signup(username='author',
+                                  email='author@test.com',
+                                  password='author',
+                                  image_url=None)
+        self.author.id = 666
+
+        self.fan = User.signup(username='fan',
+                               email='fan@test.com',
+                               password='fan',
+                               image_url=None)
+        self.fan.id = 999
+        db.session.commit()
+
+        for i in range(5):
+            db.session.add(Message(id=700 + i, text=f'warble {i}', user_id=666))
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=666, user_following_id=999))
+        db.session.add(Follows(user_being_followed_id=999, user_following_id=666))
+        db.session.add(Likes(user_id=999, message_id=700))
+        db.session.commit()
+
+        # What the routes would have counted
+        User.query.filter_by(id=666).update(dict(messages_count=5, followers_count=1,
+                                                 following_count=1))
+        User.query.filter_by(id=999).update(dict(likes_count=1, followers_count=1,
+                                                 following_count=1))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        jobs.DELETE_BATCH = 1000
+        jobs.HANDLERS.pop('explode', None)
+        self.ctx.pop()
+
+    def test_delete_user_in_background(self):
+        """Does deleting an account respond at once and finish in batches?"""
+
+        jobs.DELETE_BATCH = 2
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 666
+
+            resp = c.post('/users/delete')
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertIsNotNone(User.query.get(666))
+        self.assertEqual(Job.query.count(), 1)
+
+        # until the job has run, the account can't be used
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 666
+
+            c.post('/messages/new', data={'text': 'still here'})
+            self.assertEqual(Message.query.filter_by(text='still here').count(), 0)
+
+            resp = c.post('/login', data={'username': 'author', 'password': 'author'})
+            self.assertIn('Invalid credentials.', str(resp.data))
+
+        # three batches of messages, then the user
+        self.assertEqual(jobs.run_pending(), 4)
+        self.assertIsNone(User.query.get(666))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Job.query.count(), 0)
+
+        fan = User.query.get(999)
+        self.assertEqual((fan.likes_count, fan.followers_count, fan.following_count),
+                         (0, 0, 0))
+
+    def test_failed_jobs_retry_with_backoff(self):
+        """Is a failing job retried later, then kept as failed?"""
+
+        @jobs.handler('explode')
+        def explode():
+            raise RuntimeError("boom")
+
+        job = jobs.enqueue('explode')
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job = Job.query.get(job.id)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.last_error, "RuntimeError: boom")
+        self.assertGreater(job.run_after, datetime.utcnow())
+
+        # not due again yet
+        self.assertEqual(jobs.run_pending(), 0)
+
+        for _ in range(jobs.MAX_ATTEMPTS - 1):
+            Job.query.update(dict(run_after=datetime.utcnow()))
+            db.session.commit()
+            jobs.run_pending()
+
+        self.assertIsNotNone(Job.query.get(job.id).failed_at)
+        self.assertEqual(jobs.stats()['failed'], 1)
+
+    def test_reconcile_counters_job(self):
+        """Does the queued recount fix drifted counters?"""
+
+        User.query.update(dict(messages_count=42))
+        jobs.enqueue('reconcile_counters')
+        db.session.commit()
+
+        jobs.run_pending()
+        self.assertEqual(User.query.get(666).messages_count, 5)
+        self.assertEqual(User.query.get(999).messages_count, 0)
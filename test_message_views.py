@@ -5,7 +5,9 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import json
 import os
+from datetime import datetime
 from unittest import TestCase
 
 from models import db, connect_db, Message, User
@@ -21,6 +23,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragments
+import pagination
+import usercache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -42,6 +47,8 @@ class MessageViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
 
+        usercache.clear()
+        fragments.cache.clear()
         self.client = app.test_client()
 
         self.test_user = User.signup(username="test",
@@ -117,6 +124,105 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(message1.text, str(resp.data))
 
+    def test_anonymous_message_show_validators(self):
+        """Tests that anonymous visitors get a public, revalidatable message page"""
+
+        message1 = Message(id=666, text='test', user_id=self.test_user.id)
+        db.session.add(message1)
+        db.session.commit()
+
+        resp = self.client.get('/messages/666')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('public', resp.headers['Cache-Control'])
+        self.assertIn('Cookie', resp.headers['Vary'])
+
+        etag = resp.headers['ETag']
+        resp = self.client.get('/messages/666', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        # a profile change shows up next to the message, so the tag changes
+        User.query.filter_by(id=666).update({'version': User.version + 1})
+        db.session.commit()
+
+        resp = self.client.get('/messages/666', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_authenticated_message_show_is_private(self):
+        """Tests that pages shown to a logged-in user aren't shared or validated"""
+
+        message1 = Message(id=666, text='test', user_id=self.test_user.id)
+        db.session.add(message1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user.id
+
+            resp = c.get('/messages/666')
+            self.assertIn('private', resp.headers['Cache-Control'])
+            self.assertNotIn('ETag', resp.headers)
+
+            resp = c.post('/messages/new', data={'text': 'hello'})
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+    def test_stream_user_messages(self):
+        """Tests that a user's messages stream as NDJSON, newest first"""
+
+        for i in range(3):
+            db.session.add(Message(id=700 + i, text=f'warble {i}',
+                                   timestamp=datetime(2020, 1, 1 + i),
+                                   user_id=self.test_user.id))
+        db.session.commit()
+
+        resp = self.client.get('/api/users/666/messages')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [702, 701, 700])
+        self.assertEqual(rows[0]['username'], 'test')
+
+        cursor = pagination.encode_cursor(datetime(2020, 1, 3), 702)
+        resp = self.client.get(f'/api/users/666/messages?before={cursor}&limit=1')
+        self.assertEqual([json.loads(line)['id'] for line in resp.data.splitlines()],
+                         [701])
+
+        self.assertEqual(self.client.get('/api/users/123456/messages').status_code, 404)
+
+        # a bad limit is refused before anything is streamed
+        for limit in ['0', '-1', 'ten']:
+            resp = self.client.get(f'/api/users/666/messages?limit={limit}')
+            self.assertEqual(resp.status_code, 400, limit)
+
+    def test_stream_timeline(self):
+        """Tests that the logged-in user's timeline streams, and needs a login"""
+
+        other = User.signup(username="other",
+                            email="other@test.com",
+                            password="other",
+                            image_url=None)
+        other.id = 999
+        db.session.add_all([
+            Message(id=700, text='mine', user_id=666),
+            Message(id=701, text='followed', user_id=999),
+        ])
+        db.session.commit()
+
+        self.assertEqual(self.client.get('/api/timeline').status_code, 401)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 666
+
+            resp = c.get('/api/timeline')
+            self.assertEqual([json.loads(line)['id'] for line in resp.data.splitlines()],
+                             [700])
+
+            c.post('/users/follow/999')
+            resp = c.get('/api/timeline')
+            self.assertEqual({json.loads(line)['id'] for line in resp.data.splitlines()},
+                             {700, 701})
+
     def test_invalid_message_show(self):
         """Tests the 404 response for displaying (to an authenticated user) a message that doesn't exist"""
         with self.client as c:
@@ -164,4 +270,30 @@ class MessageViewTestCase(TestCase):
             self.assertIn('Successfully deleted your warble.', str(resp.data))
 
             message1 = Message.query.get(666)
-            self.assertIsNone(message1)
\ No newline at end of file
+            self.assertIsNone(message1)
+
+    def test_message_delete_counters(self):
+        """Tests that deleting a message updates its author's and likers' counters"""
+
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="liker",
+                            image_url=None)
+        liker.id = 999
+        message1 = Message(id=666, text='test', user_id=self.test_user.id)
+        db.session.add(message1)
+        db.session.commit()
+
+        liker.likes.append(message1)
+        User.query.filter_by(id=666).update({'messages_count': 1})
+        User.query.filter_by(id=999).update({'likes_count': 1})
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user.id
+
+            c.post('/messages/666/delete')
+
+        self.assertEqual(User.query.get(666).messages_count, 0)
+        self.assertEqual(User.query.get(999).likes_count, 0)
\ No newline at end of file
@@ -0,0 +1,152 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import migrations
+
+# Migrations run against a scratch database of their own, made afresh
+# for each test
+SCRATCH_DATABASE = 'warbler-test-migrations'
+
+# The schema `db.create_all()` made before there were migrations
+LEGACY_SCHEMA = [
+    """CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE,
+        image_url TEXT,
+        header_image_url TEXT,
+        bio TEXT,
+        location TEXT,
+        password TEXT NOT NULL
+    )""",
+    """CREATE TABLE follows (
+        user_being_followed_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        user_following_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id)
+    )""",
+    """CREATE TABLE messages (
+        id SERIAL PRIMARY KEY,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE likes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE
+    )""",
+]
+
+EXPECTED_INDEXES = {
+    'follows': {'ix_follows_user_following_id'},
+    'likes': {'ix_likes_message_id'},
+    'messages': {'ix_messages_user_timestamp'},
+    'timeline_entries': {'ix_timeline_entries_user_timestamp'},
+    'jobs': {'ix_jobs_run_after'},
+    'users': {'ix_users_username_lower'},
+}
+
+
+class MigrationTestCase(TestCase):
+    """Test upgrading new and pre-migration databases."""
+
+    def setUp(self):
+        self.server = create_engine('postgresql:///postgres',
+                                    isolation_level='AUTOCOMMIT')
+        self.server.execute(f'DROP DATABASE IF EXISTS "{SCRATCH_DATABASE}"')
+        self.server.execute(f'CREATE DATABASE "{SCRATCH_DATABASE}"')
+
+        self.engine = create_engine(f'postgresql:///{SCRATCH_DATABASE}')
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.server.execute(f'DROP DATABASE IF EXISTS "{SCRATCH_DATABASE}"')
+        self.server.dispose()
+
+    def assertCurrentSchema(self):
+        """Check the tables, columns, indexes and constraints match the models."""
+
+        inspector = inspect(self.engine)
+
+        self.assertLessEqual(set(db.metadata.tables), set(inspector.get_table_names()))
+
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            self.assertEqual(columns, {column.name for column in table.columns},
+                             table.name)
+
+        # (from pg_indexes, as reflection skips expression indexes)
+        for table, expected in EXPECTED_INDEXES.items():
+            indexes = {name for (name,) in self.engine.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename = %s", table)}
+            self.assertLessEqual(expected, indexes, table)
+
+        unique = {constraint['name']
+                  for constraint in inspector.get_unique_constraints('likes')}
+        self.assertEqual(unique, {'likes_user_id_message_id_key'})
+
+        with self.engine.connect() as conn:
+            self.assertEqual(migrations.current_version(conn),
+                             migrations.MIGRATIONS[-1][0])
+
+    def test_fresh_database(self):
+        """Does upgrading an empty database build the whole schema?"""
+
+        with app.app_context():
+            applied = migrations.upgrade(self.engine)
+
+        self.assertEqual(applied, [version for version, _ in migrations.MIGRATIONS])
+        self.assertCurrentSchema()
+
+        # and a second upgrade has nothing left to do
+        with app.app_context():
+            self.assertEqual(migrations.upgrade(self.engine), [])
+
+    def test_legacy_database(self):
+        """Does upgrading a pre-migration database keep its data and fix its schema?"""
+
+        with self.engine.begin() as conn:
+            for statement in LEGACY_SCHEMA:
+                conn.execute(statement)
+            conn.execute("INSERT INTO users (id, email, username, password) "
+                         "VALUES (1, 'a@test.com', 'a', 'x'), (2, 'b@test.com', 'b', 'x')")
+            conn.execute("INSERT INTO follows VALUES (2, 1)")
+            conn.execute("INSERT INTO messages (id, text, timestamp, user_id) "
+                         "VALUES (1, 'hello', now(), 2)")
+            conn.execute("INSERT INTO likes (user_id, message_id) VALUES (1, 1)")
+
+        with app.app_context():
+            migrations.upgrade(self.engine)
+
+        self.assertCurrentSchema()
+
+        # the new counters were filled in from the existing rows
+        counters = dict(self.engine.execute(
+            "SELECT username, (messages_count, following_count, followers_count, "
+            "likes_count)::text FROM users").fetchall())
+        self.assertEqual(counters, {'a': '(0,1,0,1)', 'b': '(1,0,1,0)'})
+
+        # and a second user may now like the same message
+        self.engine.execute("INSERT INTO likes (user_id, message_id) VALUES (2, 1)")
@@ -0,0 +1,59 @@
+"""Password hasher tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+from unittest import TestCase
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test the bounded bcrypt pool."""
+
+    def setUp(self):
+        self.hasher = PasswordHasher(log_rounds=4, workers=2, max_pending=2)
+
+    def test_hash_and_check(self):
+        """Does a hash made on the pool verify against the right password only?"""
+
+        hashed = self.hasher.hash('secret')
+
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(self.hasher.check(hashed, 'secret'))
+        self.assertFalse(self.hasher.check(hashed, 'wrong'))
+        self.assertEqual(self.hasher.stats()['completed'], 3)
+
+    def test_needs_rehash(self):
+        """Are hashes at a different work factor flagged for re-hashing?"""
+
+        self.assertFalse(self.hasher.needs_rehash(self.hasher.hash('secret')))
+        self.assertTrue(self.hasher.needs_rehash(
+            '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'))
+        self.assertTrue(self.hasher.needs_rehash('not a hash'))
+
+    def test_verify_rehashes_in_one_job(self):
+        """Is an outdated hash checked and re-hashed without a second queue slot?"""
+
+        old = PasswordHasher(log_rounds=5).hash('secret')
+        single = PasswordHasher(log_rounds=4, workers=1, max_pending=1)
+
+        matches, rehashed = single.verify(old, 'secret')
+        self.assertTrue(matches)
+        self.assertTrue(rehashed.startswith('$2b$04$'))
+        self.assertEqual(single.stats()['completed'], 1)
+
+        self.assertEqual(single.verify(old, 'wrong'), (False, None))
+        self.assertEqual(single.verify(rehashed, 'secret'), (True, None))
+
+    def test_back_pressure(self):
+        """Is work rejected straight away once the queue is full?"""
+
+        full = PasswordHasher(log_rounds=4, workers=1, max_pending=0)
+
+        with self.assertRaises(PasswordHasherBusy):
+            full.hash('secret')
+
+        self.assertEqual(full.stats()['rejected'], 1)
@@ -0,0 +1,141 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import instrumentation
+import ratelimit
+import usercache
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TokenBucketsTestCase(TestCase):
+    """Test the in-process token buckets."""
+
+    def test_burst_then_refill(self):
+        """Does a bucket allow a burst, then one request per refill?"""
+
+        buckets = ratelimit.TokenBuckets()
+        capacity, rate = ratelimit.parse_rate('3/minute')
+
+        for _ in range(3):
+            self.assertEqual(buckets.take(['ip:1'], capacity, rate, now=0), 0)
+        self.assertAlmostEqual(buckets.take(['ip:1'], capacity, rate, now=0), 20)
+
+        # other clients have buckets of their own
+        self.assertEqual(buckets.take(['ip:2'], capacity, rate, now=0), 0)
+
+        self.assertEqual(buckets.take(['ip:1'], capacity, rate, now=20), 0)
+        self.assertGreater(buckets.take(['ip:1'], capacity, rate, now=20), 0)
+
+        self.assertEqual(buckets.stats()['limited'], 2)
+
+    def test_denied_takes_nothing(self):
+        """Does a request one bucket turns away leave its other buckets full?"""
+
+        buckets = ratelimit.TokenBuckets()
+
+        self.assertEqual(buckets.take(['user:a'], 1, 1, now=0), 0)
+        self.assertGreater(buckets.take(['ip:1', 'user:a'], 1, 1, now=0), 0)
+
+        # ip:1 still has its token for another user
+        self.assertEqual(buckets.take(['ip:1', 'user:b'], 1, 1, now=0), 0)
+
+    def test_table_is_bounded(self):
+        """Are the least recently used buckets dropped when the table is full?"""
+
+        buckets = ratelimit.TokenBuckets(max_size=2)
+        for key in ['a', 'b', 'c']:
+            buckets.take([key], 1, 1, now=0)
+
+        self.assertEqual(buckets.stats()['buckets'], 2)
+        self.assertEqual(buckets.take(['a'], 1, 1, now=0), 0)
+        self.assertGreater(buckets.take(['c'], 1, 1, now=0), 0)
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test that limited views turn away clients over their limit."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        User.signup(username='limited',
+                    email='limited@test.com',
+                    password='limited',
+                    image_url=None).id = 666
+        db.session.commit()
+
+        self.limits = dict(app.config['RATELIMITS'])
+        app.config['RATELIMITS'].update(login='2/minute', post='1/minute')
+
+        ratelimit.buckets.clear()
+        usercache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['RATELIMITS'] = self.limits
+        ratelimit.buckets.clear()
+
+    def test_login_limited_before_any_work(self):
+        """Is a third login attempt turned away without a query or a hash?"""
+
+        for _ in range(2):
+            resp = self.client.post('/login', data={'username': 'limited',
+                                                    'password': 'wrong'})
+            self.assertEqual(resp.status_code, 200)
+
+        instrumentation.metrics.reset()
+        resp = self.client.post('/login', data={'username': 'limited',
+                                                'password': 'limited'})
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('Retry-After', resp.headers)
+
+        stats = instrumentation.metrics.snapshot()['endpoints']['login']
+        self.assertEqual(stats['queries'], 0)
+
+        # showing the form isn't limited
+        self.assertEqual(self.client.get('/login').status_code, 200)
+
+    def test_limits_are_per_user(self):
+        """Does one user's posting leave other users' buckets alone?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 666
+
+            resp = c.post('/messages/new', data={'text': 'first'})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.post('/messages/new', data={'text': 'second'})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(Message.query.count(), 1)
+
+        capacity, rate = ratelimit.parse_rate('1/minute')
+        self.assertEqual(ratelimit.buckets.take(['post:user:999'], capacity, rate), 0)
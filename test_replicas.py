@@ -0,0 +1,114 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import replicas
+import usercache
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test that read-only views read from a replica.
+
+    The "replica" is a SQLite file holding different rows from the
+    (Postgres) primary, so each response shows where it was read from.
+    """
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        User.signup(username='onprimary',
+                    email='primary@test.com',
+                    password='primary',
+                    image_url=None).id = 666
+        db.session.commit()
+
+        self.replica_dir = tempfile.TemporaryDirectory()
+        url = f'sqlite:///{self.replica_dir.name}/replica.db'
+        app.config['REPLICA_DATABASE_URIS'] = [url]
+        app.config['SQLALCHEMY_BINDS'] = {'replica_0': url}
+
+        self.replica = db.get_engine(app, bind='replica_0')
+        db.metadata.create_all(bind=self.replica)
+        self.replica.execute(User.__table__.insert().values(
+            id=777,
+            username='onreplica',
+            email='replica@test.com',
+            password='replica',
+        ))
+
+        usercache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.replica.dispose()
+        self.replica_dir.cleanup()
+
+        app.config['REPLICA_DATABASE_URIS'] = []
+        app.config['SQLALCHEMY_BINDS'] = None
+
+    def test_read_only_views_use_replica(self):
+        """Do read-only views read from the replica, and others from the primary?"""
+
+        resp = self.client.get('/users/777')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('@onreplica', str(resp.data))
+
+        self.assertEqual(self.client.get('/users/666').status_code, 404)
+
+        resp = self.client.post('/login', data={'username': 'onprimary',
+                                                'password': 'primary'})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_reads_stick_to_primary_after_write(self):
+        """After a write, do the visitor's reads go to the primary for a while?"""
+
+        self.client.post('/login', data={'username': 'onprimary',
+                                         'password': 'primary'})
+
+        self.assertEqual(self.client.get('/users/666').status_code, 200)
+        self.assertEqual(self.client.get('/users/777').status_code, 404)
+
+        with self.client.session_transaction() as sess:
+            sess[replicas.STICKY_KEY] = 0
+
+        self.assertEqual(self.client.get('/users/777').status_code, 200)
+
+    def test_writes_go_to_primary(self):
+        """Are writes sent to the primary even from a read-only view?"""
+
+        with app.test_request_context('/users/777'):
+            update = User.__table__.update().values(bio='changed')
+
+            self.assertIs(db.session.get_bind(clause=update), db.engine)
+            self.assertIs(db.session.get_bind(mapper=User.__mapper__), self.replica)
@@ -0,0 +1,61 @@
+"""Seed loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import os
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import seed
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class DeferredIndexesTestCase(TestCase):
+    """Test dropping and restoring indexes around a load."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def index_names(self):
+        return {name for (name,) in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages'")}
+
+    def test_failed_load_restores_indexes(self):
+        """Are the indexes rebuilt even when the load fails?"""
+
+        before = self.index_names()
+        self.assertIn('ix_messages_user_timestamp', before)
+
+        with self.assertRaises(ValueError):
+            with seed.deferred_indexes(['messages']):
+                db.session.commit()
+                self.assertNotIn('ix_messages_user_timestamp', self.index_names())
+                raise ValueError("bad CSV")
+
+        db.session.commit()
+        self.assertEqual(self.index_names(), before)
@@ -0,0 +1,305 @@
+"""Precomputed timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Job, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import fragments
+import jobs
+import pagination
+import usercache
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out on write timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Job.query.delete()
+
+        app.config['TIMELINE_FANOUT'] = True
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        usercache.clear()
+        fragments.cache.clear()
+        self.client = app.test_client()
+
+        self.test_user1 = User.signup(username='test1',
+                                      email='test1@test.com',
+                                      password='test1',
+                                      image_url=None)
+        self.test_user1.id = 666
+
+        self.test_user2 = User.signup(username='test2',
+                                      email='test2@test.com',
+                                      password='test2',
+                                      image_url=None)
+        self.test_user2.id = 999
+
+        db.session.commit()
+
+        warble = Message(id=999, text='an older warble', user_id=999)
+        db.session.add(warble)
+        db.session.commit()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['TIMELINE_FANOUT'] = False
+        self.ctx.pop()
+        return res
+
+    def timeline_ids(self, user_id):
+        """Message ids currently in `user_id`'s timeline."""
+
+        return [m.id for m in timeline.read(user_id).items]
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        """Does following copy in old messages, and unfollowing remove them?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 666
+
+            c.post('/users/follow/999')
+            self.assertEqual(self.timeline_ids(666), [999])
+
+            c.post('/users/stop-following/999')
+            self.assertEqual(self.timeline_ids(666), [])
+
+    def test_new_message_fans_out(self):
+        """Does a new message reach its author and their followers?"""
+
+        self.test_user1.following.append(self.test_user2)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 999
+
+            c.post('/messages/new', data={"text": "fresh warble"})
+
+        # the author sees it at once; followers once the job has run
+        msg = Message.query.filter_by(text='fresh warble').one()
+        self.assertEqual(self.timeline_ids(999), [msg.id])
+        self.assertEqual(self.timeline_ids(666), [])
+
+        jobs.run_pending()
+        self.assertEqual(self.timeline_ids(666), [msg.id])
+
+    def test_fan_out_in_batches(self):
+        """Is a message delivered one batch of followers at a time?"""
+
+        for i in range(3):
+            follower = User.signup(username=f'follower{i}',
+                                   email=f'follower{i}@test.com',
+                                   password='follower',
+                                   image_url=None)
+            follower.id = 1000 + i
+            follower.following.append(self.test_user2)
+        db.session.commit()
+
+        self.assertEqual(timeline.fan_out(999, limit=2), 1001)
+        self.assertIsNone(timeline.fan_out(999, after=1001, limit=2))
+
+        # delivering again (e.g. a retried job) doesn't duplicate entries
+        self.assertEqual(timeline.fan_out(999, limit=2), 1001)
+        for i in range(3):
+            self.assertEqual(self.timeline_ids(1000 + i), [999])
+
+    def test_homepage_reads_timeline(self):
+        """Does the homepage render from the precomputed timeline?"""
+
+        timeline.rebuild(999)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 999
+
+            resp = c.get('/')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('an older warble', str(resp.data))
+
+    def test_pulled_authors_are_merged_at_read_time(self):
+        """Are popular authors' messages merged in when read, instead of pushed?"""
+
+        app.config['TIMELINE_PULL_THRESHOLD'] = 1
+        try:
+            self.test_user1.following.append(self.test_user2)
+            self.test_user2.followers_count = 1
+            db.session.add(Message(id=1000, text='by test1', user_id=666))
+            db.session.add(Message(id=1001, text='by test2', user_id=999))
+            db.session.commit()
+
+            timeline.rebuild(666)
+            self.assertIsNone(timeline.fan_out(1001))
+            db.session.commit()
+
+            self.assertEqual(
+                [e.message_id for e in TimelineEntry.query.filter_by(user_id=666)],
+                [1000])
+
+            self.assertEqual(self.timeline_ids(666), [1001, 1000, 999])
+
+            page = timeline.read(666, limit=2)
+            self.assertEqual([m.id for m in page.items], [1001, 1000])
+            page = timeline.read(666, before=pagination.decode_cursor(page.next_cursor),
+                                 limit=2)
+            self.assertEqual([m.id for m in page.items], [999])
+            self.assertIsNone(page.next_cursor)
+
+            # pushed copies from before test2 crossed the threshold aren't repeated
+            app.config['TIMELINE_PULL_THRESHOLD'] = 10
+            timeline.rebuild(666)
+            app.config['TIMELINE_PULL_THRESHOLD'] = 1
+            db.session.commit()
+            self.assertEqual(self.timeline_ids(666), [1001, 1000, 999])
+
+            self.assertGreater(timeline.merge_stats.as_dict()['reads'], 0)
+        finally:
+            app.config['TIMELINE_PULL_THRESHOLD'] = 10000
+
+    def test_pull_self_follow(self):
+        """Does a self-follow left in the table not repeat the user's messages?"""
+
+        db.session.add(Follows(user_being_followed_id=999, user_following_id=999))
+        db.session.add(Message(id=1000, text='another', user_id=999))
+        db.session.add(Message(id=1001, text='and another', user_id=999))
+        db.session.commit()
+
+        page = timeline.pull(999, limit=2)
+        self.assertEqual([m.id for m in page.items], [1001, 1000])
+        page = timeline.pull(999, before=pagination.decode_cursor(page.next_cursor),
+                             limit=2)
+        self.assertEqual([m.id for m in page.items], [999])
+        self.assertIsNone(page.next_cursor)
+
+    def test_follow_at_pull_threshold(self):
+        """Does the follow that makes an author pulled skip the backfill?"""
+
+        fan = User.signup(username='fan', email='fan@test.com',
+                          password='fan', image_url=None)
+        fan.id = 1000
+        fan.following.append(self.test_user2)
+        self.test_user2.followers_count = 1
+        db.session.commit()
+
+        # the session's copy of test2 still has one follower
+        User.query.get(999)
+
+        app.config['TIMELINE_PULL_THRESHOLD'] = 2
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 666
+
+                c.post('/users/follow/999')
+
+            self.assertEqual(TimelineEntry.query.filter_by(user_id=666).count(), 0)
+            self.assertEqual(self.timeline_ids(666), [999])
+        finally:
+            app.config['TIMELINE_PULL_THRESHOLD'] = 10000
+
+    def test_trim(self):
+        """Are timelines capped at TIMELINE_LENGTH entries as messages fan out?"""
+
+        self.test_user1.following.append(self.test_user2)
+        db.session.commit()
+
+        app.config['TIMELINE_LENGTH'] = 2
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 999
+
+                for i in range(5):
+                    c.post('/messages/new', data={"text": f"warble {i}"})
+
+            jobs.run_pending()
+
+            newest = [m.id for m in (Message.query
+                                     .filter(Message.text.like('warble %'))
+                                     .order_by(Message.id.desc())
+                                     .limit(2))]
+
+            for user_id in (666, 999):
+                entries = TimelineEntry.query.filter_by(user_id=user_id)
+                self.assertEqual(entries.count(), 2)
+                self.assertEqual(
+                    sorted(entry.message_id for entry in entries), sorted(newest))
+        finally:
+            app.config['TIMELINE_LENGTH'] = 800
+
+    def test_trim_plan(self):
+        """Does trimming read each timeline through its index, not the whole table?"""
+
+        timeline.rebuild(999)
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        app.config['TIMELINE_LENGTH'] = 0
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            timeline.trim(666, 999)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+            app.config['TIMELINE_LENGTH'] = 800
+            db.session.rollback()
+
+        # finding the overflow, then deleting it
+        self.assertEqual(len(statements), 2)
+
+        raw_conn = db.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            # the table is tiny, so make scanning it unattractive
+            cursor.execute('SET enable_seqscan = off')
+            for statement, parameters in statements:
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                plan = '\n'.join(line for (line,) in cursor.fetchall())
+                self.assertRegex(plan, 'ix_timeline_entries_user_timestamp|'
+                                       'timeline_entries_pkey')
+                self.assertNotIn('Seq Scan on timeline_entries', plan)
+                self.assertNotIn('WindowAgg', plan)
+            raw_conn.rollback()
+        finally:
+            raw_conn.close()
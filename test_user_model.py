@@ -9,6 +9,8 @@ import os
 from unittest import TestCase
 from sqlalchemy import exc
 from models import db, User, Message, Follows
+import counters
+from passwords import hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -125,6 +127,37 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.test1.is_followed_by(self.test2), 0)
 
     
+    def test_following_ids(self):
+        """Does following_ids pick out just the followed users from a batch?"""
+
+        self.test1.following.append(self.test2)
+        db.session.commit()
+
+        self.assertEqual(self.test1.following_ids([self.test1, self.test2]), {self.id2})
+        self.assertEqual(self.test2.following_ids([self.test1, self.test2]), set())
+        self.assertEqual(self.test1.following_ids([]), set())
+
+
+    def test_reconcile_counters(self):
+        """Does reconcile() repair counters that have drifted from the tables?"""
+
+        self.test1.following.append(self.test2)
+        db.session.add(Message(text='test', user_id=self.id1))
+        db.session.commit()
+
+        self.assertEqual(self.test1.following_count, 0)
+
+        counters.reconcile()
+        db.session.commit()
+
+        test1 = User.query.get(self.id1)
+        test2 = User.query.get(self.id2)
+        self.assertEqual(test1.following_count, 1)
+        self.assertEqual(test1.messages_count, 1)
+        self.assertEqual(test2.followers_count, 1)
+        self.assertEqual(test2.following_count, 0)
+
+
     def test_invalid_signup(self):
         """Tests that the validations on the User field run properly on username, email, and password"""
 
@@ -162,4 +195,20 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.test1.authenticate('wasedfj', 'test1'), False)
 
         #test invalid password
-        self.assertEqual(self.test1.authenticate('test1', 'quwaygeuh'), False)
\ No newline at end of file
+        self.assertEqual(self.test1.authenticate('test1', 'quwaygeuh'), False)
+
+
+    def test_authenticate_rehashes(self):
+        """Does a successful login upgrade a hash made at a different work factor?"""
+
+        old_hash = self.test1.password
+        hasher.log_rounds = 4
+        try:
+            user = User.authenticate('test1', 'test1')
+            db.session.commit()
+
+            self.assertNotEqual(user.password, old_hash)
+            self.assertTrue(user.password.startswith('$2b$04$'))
+            self.assertEqual(User.authenticate('test1', 'test1'), user)
+        finally:
+            hasher.log_rounds = 12
@@ -8,6 +8,8 @@
 import os
 from unittest import TestCase
 
+from sqlalchemy import event
+
 from models import db, connect_db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
@@ -21,6 +23,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragments
+import search
+import usercache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -42,6 +47,8 @@ class UserViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
 
+        usercache.clear()
+        fragments.cache.clear()
         self.client = app.test_client()
 
         #create test users
@@ -84,6 +91,74 @@ class UserViewTestCase(TestCase):
             self.assertIn('@test2', str(resp.data))
 
     
+    def test_search_users(self):
+        """Tests that searching ranks matching users and excludes the rest"""
+
+        with self.client as c:
+            resp = c.get('/users?q=st2')
+            self.assertIn('@test2', str(resp.data))
+            self.assertNotIn('@test1', str(resp.data))
+
+            resp = c.get('/users?q=%25')
+            self.assertIn('Sorry, no users found', str(resp.data))
+
+
+    def test_users_autocomplete(self):
+        """Tests the JSON username autocomplete endpoint"""
+
+        with self.client as c:
+            resp = c.get('/api/users/autocomplete?q=TEST')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([u['username'] for u in resp.get_json()['users']],
+                             ['test1', 'test2'])
+
+            resp = c.get('/api/users/autocomplete?q=est')
+            self.assertEqual(resp.get_json()['users'], [])
+
+            # prefixes whose last character can't simply be incremented
+            for q in ['test\U0010ffff', 'test\ud7ff', '\U0010ffff', 'te\x00']:
+                resp = c.get('/api/users/autocomplete', query_string={'q': q})
+                self.assertEqual(resp.status_code, 200, repr(q))
+                self.assertEqual(resp.get_json()['users'], [])
+
+        self.assertEqual(search._after_prefix('ab'), 'ac')
+        self.assertEqual(search._after_prefix('a\ud7ff'), 'a\ue000')
+        self.assertEqual(search._after_prefix('a\U0010ffff'), 'b')
+        self.assertIsNone(search._after_prefix('\U0010ffff'))
+
+    def test_users_autocomplete_plan(self):
+        """Tests that autocomplete reads the lower(username) index in order"""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if 'lower(users.username)' in statement:
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.client.get('/api/users/autocomplete?q=te')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(len(statements), 1)
+        statement, parameters = statements[0]
+
+        raw_conn = db.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            # the table is tiny, so make scanning it unattractive
+            cursor.execute('SET enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(line for (line,) in cursor.fetchall())
+            raw_conn.rollback()
+        finally:
+            raw_conn.close()
+
+        self.assertIn('ix_users_username_lower', plan)
+        self.assertNotIn('Sort', plan)
+
+
     def test_users_show(self):
         """Tests whether the route displays a user in db"""
 
@@ -92,6 +167,142 @@ class UserViewTestCase(TestCase):
             self.assertIs(resp.status_code, 200)
             self.assertIn('@test1', str(resp.data))
 
+    def test_users_show_pagination(self):
+        """Tests that a profile pages through messages with an 'older' cursor"""
+
+        for i in range(2):
+            db.session.add(Message(text=f'older warble {i}', user_id=self.test_user1.id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f'/users/{self.test_user1.id}?limit=2')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Older warbles', str(resp.data))
+            self.assertNotIn('testtesttest', str(resp.data))
+
+            cursor = resp.data.decode().split('before=')[1].split('&')[0]
+            resp = c.get(f'/users/{self.test_user1.id}?limit=2&before={cursor}')
+            self.assertIn('testtesttest', str(resp.data))
+            self.assertNotIn('Older warbles', str(resp.data))
+
+            resp = c.get(f'/users/{self.test_user1.id}?before=garbage')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_anonymous_profile_validators(self):
+        """Tests that a public profile answers 304 until it gets a new message"""
+
+        resp = self.client.get(f'/users/{self.test_user1.id}')
+        etag = resp.headers['ETag']
+
+        resp = self.client.get(f'/users/{self.test_user1.id}',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        db.session.add(Message(id=667, text='newer', user_id=self.test_user1.id))
+        db.session.commit()
+
+        resp = self.client.get(f'/users/{self.test_user1.id}',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('newer', str(resp.data))
+
+    def test_personalized_profile_skips_validator(self):
+        """Tests that a logged-in profile view gets no ETag and skips its query"""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user1.id
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                resp = c.get(f'/users/{self.test_user1.id}')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertNotIn('ETag', resp.headers)
+        self.assertFalse([statement for statement in statements
+                          if 'max(messages.id)' in statement])
+
+    def test_current_user_cache(self):
+        """Tests that the logged-in user is served from cache until their profile changes"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user1.id
+
+            c.get('/')
+            hits = usercache.cache.stats()['hits']
+            c.get('/')
+            self.assertEqual(usercache.cache.stats()['hits'], hits + 1)
+
+            c.post('/users/profile', data={'username': 'renamed',
+                                           'email': 'test@test.com',
+                                           'password': 'testtest'})
+            resp = c.get('/')
+            self.assertIn('@renamed', str(resp.data))
+
+    def test_current_user_cache_leaves_out_secrets(self):
+        """Tests that the user cache holds no password hash or email"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user1.id
+
+            c.get('/')
+            snapshot = usercache.cache.get(self.test_user1.id)
+            self.assertEqual(snapshot['username'], 'test1')
+            self.assertNotIn('password', snapshot)
+            self.assertNotIn('email', snapshot)
+
+            # the rest still loads when a page needs it
+            resp = c.get('/users/profile')
+            self.assertIn('test@test.com', str(resp.data))
+
+    def test_current_user_cache_deleted_user(self):
+        """Tests that a user deleted behind the cache's back can't write"""
+
+        user_id = self.test_user1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get('/')
+
+            # as the job worker would, in another process
+            User.query.filter(User.id == user_id).delete()
+            db.session.commit()
+
+            resp = c.post('/messages/new', data={'text': 'ghost warble'})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Message.query.filter_by(text='ghost warble').count(), 0)
+            self.assertIsNone(usercache.cache.get(user_id))
+
+    def test_message_fragment_cache(self):
+        """Tests that message list items are rendered once and redrawn after a profile change"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user1.id
+
+            c.get(f'/users/{self.test_user1.id}')
+            hits = fragments.cache.stats()['hits']
+            resp = c.get(f'/users/{self.test_user1.id}')
+            self.assertEqual(fragments.cache.stats()['hits'], hits + 1)
+            self.assertIn('testtesttest', str(resp.data))
+
+            c.post('/users/profile', data={'username': 'renamed',
+                                           'email': 'test@test.com',
+                                           'password': 'testtest'})
+            resp = c.get(f'/users/{self.test_user1.id}')
+            self.assertIn('@renamed', str(resp.data))
+
+
     def test_show_following(self):
         """Tests whether the route displays the users the current user is following"""
 
@@ -114,6 +325,42 @@ class UserViewTestCase(TestCase):
             self.assertIs(resp.status_code, 200)
             self.assertIn('@test1', str(resp.data))
 
+
+    def test_followers_pages(self):
+        """Tests that the followers page is paged, with each row's follow state"""
+        for id in range(1000, 1003):
+            follower = User.signup(username=f'follower{id}',
+                                   email=f'follower{id}@test.com',
+                                   password='test',
+                                   image_url=None)
+            follower.id = id
+            follower.following.append(self.test_user2)
+        self.test_user2.following.append(User.query.get(1001))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 999
+
+            resp = c.get('/users/999/followers?limit=2')
+            html = str(resp.data)
+            self.assertIn('@follower1002', html)
+            self.assertIn('@follower1001', html)
+            self.assertNotIn('@follower1000', html)
+            self.assertIn('/users/stop-following/1001', html)
+            self.assertIn('/users/follow/1002', html)
+            self.assertIn('before=1001', html)
+
+            resp = c.get('/users/999/followers?limit=2&before=1001')
+            html = str(resp.data)
+            self.assertIn('@follower1000', html)
+            self.assertIn('@test1', html)
+            self.assertNotIn('@follower1001', html)
+            self.assertNotIn('before=', html)
+
+            resp = c.get('/users/999/followers?before=nope')
+            self.assertEqual(resp.status_code, 400)
+
     
     def test_add_follow_invalid(self):
         """Tests that an unauthenticated user cannot follow another user"""
@@ -134,6 +381,33 @@ class UserViewTestCase(TestCase):
             self.assertIn('@test1', str(resp.data))
 
 
+    def test_add_follow_self(self):
+        """Tests that a user cannot follow themselves"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user2.id
+
+            resp = c.post('users/follow/999', follow_redirects=True)
+            self.assertIn("You can&#39;t follow yourself.", str(resp.data))
+            self.assertEqual(User.query.get(999).following_count, 0)
+            self.assertEqual(User.query.get(999).following, [])
+
+
+    def test_follow_counters(self):
+        """Tests that following and unfollowing keep both users' counters in step"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user2.id
+
+            c.post('users/follow/666')
+            self.assertEqual(User.query.get(999).following_count, 1)
+            self.assertEqual(User.query.get(666).followers_count, 1)
+
+            c.post('users/stop-following/666')
+            self.assertEqual(User.query.get(999).following_count, 0)
+            self.assertEqual(User.query.get(666).followers_count, 0)
+
+
     def test_stop_following_invalid(self):
         """Tests whether an authenticated user can unfollow another user."""
         with self.client as c:
@@ -163,6 +437,30 @@ class UserViewTestCase(TestCase):
             self.assertIs(resp.status_code, 200)
             self.assertIn('testtesttest', str(resp.data))
 
+    def test_likes_pages(self):
+        """Tests that the likes page lists the newest liked warbles a page at a time"""
+        for id in range(667, 670):
+            db.session.add(Message(id=id, text=f'warble{id}', user_id=666))
+        db.session.commit()
+        for id in range(667, 670):
+            db.session.add(Likes(user_id=999, message_id=id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user2.id
+
+            resp = c.get('/users/999/likes?limit=3')
+            html = str(resp.data)
+            self.assertIn('warble669', html)
+            self.assertIn('warble667', html)
+            self.assertNotIn('testtesttest', html)
+
+            resp = c.get('/users/999/likes?limit=3&before=667')
+            html = str(resp.data)
+            self.assertIn('testtesttest', html)
+            self.assertNotIn('warble667', html)
+
     def test_like_and_unlike(self):
         """Tests whether the like_message() view function allows user to like and unlike a message"""
         with self.client as c:
@@ -184,6 +482,56 @@ class UserViewTestCase(TestCase):
             self.assertEqual(len(likes), 1)
 
 
+    def test_like_api(self):
+        """Tests that liking and unliking through the API is idempotent and reports the count"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user1.id
+
+            # test_user2 already likes the message; a second user can too
+            resp = c.put('/api/messages/666/like')
+            self.assertEqual(resp.json, {'liked': True, 'count': 2})
+
+            resp = c.put('/api/messages/666/like')
+            self.assertEqual(resp.json, {'liked': True, 'count': 2})
+            self.assertEqual(User.query.get(666).likes_count, 1)
+
+            resp = c.delete('/api/messages/666/like')
+            self.assertEqual(resp.json, {'liked': False, 'count': 1})
+
+            resp = c.delete('/api/messages/666/like')
+            self.assertEqual(resp.json, {'liked': False, 'count': 1})
+            self.assertEqual(User.query.get(666).likes_count, 0)
+
+            resp = c.put('/api/messages/123456/like')
+            self.assertEqual(resp.status_code, 404)
+
+    def test_unauthorized_like_api(self):
+        """Tests that the like API refuses anonymous requests"""
+
+        resp = self.client.put('/api/messages/666/like')
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(Likes.query.filter(Likes.message_id == 666).count(), 1)
+
+    def test_homepage_like_state(self):
+        """Tests that the homepage marks messages the current user has liked"""
+        self.test_user2.following.append(self.test_user1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.test_user2.id
+
+            resp = c.get('/')
+            self.assertIn('@test1', str(resp.data))
+            self.assertIn('data-liked="true"', str(resp.data))
+
+            c.post('/users/add_like/666')
+            resp = c.get('/')
+            self.assertIn('data-liked="false"', str(resp.data))
+
+
     def test_unauthorized_like(self):
         """Test that unauthorized user cannot like messages"""
         with self.client as c:
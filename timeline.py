@@ -0,0 +1,390 @@
+"""Precomputed home timelines for Warbler (hybrid fan-out on write).
+
+When `TIMELINE_FANOUT` is switched on, every new message is pushed into
+the timeline of its author and each of the author's followers, so the
+homepage reads one pre-sorted list instead of joining through `follows`.
+The author's copy is written straight away; followers' copies are
+delivered in batches by a background job (see jobs.py).
+
+Pushing to every follower stops paying off for the most followed
+accounts, so authors with `TIMELINE_PULL_THRESHOLD` or more followers
+are pulled instead: reading a timeline merges the precomputed entries
+with each followed pulled author's own (indexed, already sorted)
+messages. How much merging that costs is reported under `timeline` in
+/metrics.
+
+Following someone backfills their recent messages; unfollowing prunes
+them again. Each timeline is capped at `TIMELINE_LENGTH` entries.
+"""
+
+import heapq
+import threading
+import time
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import and_, exists, literal, select, text, true, tuple_
+
+from models import db, Follows, Message, TimelineEntry, User
+import pagination
+
+DEFAULT_TIMELINE_LENGTH = 800
+DEFAULT_PULL_THRESHOLD = 10000
+
+# Followers a new message is delivered to per fan-out job
+FAN_OUT_BATCH = 1000
+
+
+def is_enabled():
+    """Is fan-out on write switched on for this app?"""
+
+    return current_app.config.get('TIMELINE_FANOUT', False)
+
+
+def timeline_length():
+    """Maximum number of entries kept in a single timeline."""
+
+    return current_app.config.get('TIMELINE_LENGTH', DEFAULT_TIMELINE_LENGTH)
+
+
+def pull_threshold():
+    """Follower count from which an author's messages are pulled, not pushed."""
+
+    return current_app.config.get('TIMELINE_PULL_THRESHOLD', DEFAULT_PULL_THRESHOLD)
+
+
+def is_pulled(user):
+    """Are `user`'s messages merged in at read time rather than fanned out?"""
+
+    return user.followers_count >= pull_threshold()
+
+
+def pulled_authors(user_id):
+    """Ids of the pulled authors `user_id` follows."""
+
+    return [author_id for (author_id,) in (
+        db.session
+        .query(Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id,
+                User.followers_count >= pull_threshold()))]
+
+
+class MergeStats:
+    """Running totals for the read-time merges of pulled authors."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.streams = 0
+        self.max_streams = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def record(self, streams, rows, seconds):
+        with self._lock:
+            self.reads += 1
+            self.streams += streams
+            self.max_streams = max(self.max_streams, streams)
+            self.rows += rows
+            self.seconds += seconds
+
+    def as_dict(self):
+        with self._lock:
+            n = self.reads or 1
+            return dict(
+                reads=self.reads,
+                avg_streams=round(self.streams / n, 2),
+                max_streams=self.max_streams,
+                rows_merged=self.rows,
+                merge_ms=round(self.seconds * 1000, 2),
+                avg_merge_ms=round(self.seconds * 1000 / n, 3),
+            )
+
+
+merge_stats = MergeStats()
+
+
+def _not_in_timeline(user_id):
+    """Clause excluding messages already in `user_id`'s timeline."""
+
+    return ~exists().where(and_(TimelineEntry.user_id == user_id,
+                                TimelineEntry.message_id == Message.id))
+
+
+def post(msg):
+    """Put a newly flushed message into its author's own timeline.
+
+    Followers get it later, from fan_out() run as a background job.
+    """
+
+    db.session.execute(TimelineEntry.__table__.insert().values(
+        user_id=msg.user_id,
+        message_id=msg.id,
+        timestamp=msg.timestamp,
+    ))
+    trim(msg.user_id)
+
+
+def fan_out(message_id, after=0, limit=FAN_OUT_BATCH):
+    """Push a message into the timelines of one batch of its author's followers.
+
+    Delivers to up to `limit` followers whose ids are above `after`.
+    Returns the last follower id delivered to, to continue from, or None
+    once every follower has it.
+    """
+
+    msg = Message.query.get(message_id)
+    if msg is None or is_pulled(msg.user):
+        return None
+
+    batch = [follower_id for (follower_id,) in (
+        db.session
+        .query(Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == msg.user_id,
+                Follows.user_following_id > after)
+        .order_by(Follows.user_following_id)
+        .limit(limit))]
+
+    if not batch:
+        return None
+
+    # Someone who followed after the message was posted has it already
+    already_delivered = exists().where(and_(
+        TimelineEntry.user_id == Follows.user_following_id,
+        TimelineEntry.message_id == msg.id))
+
+    followers = (select([Follows.user_following_id,
+                         literal(msg.id),
+                         literal(msg.timestamp)])
+                 .where(Follows.user_being_followed_id == msg.user_id)
+                 .where(Follows.user_following_id.in_(batch))
+                 .where(~already_delivered))
+
+    db.session.execute(TimelineEntry.__table__.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], followers))
+    trim(*batch)
+
+    return batch[-1] if len(batch) == limit else None
+
+
+def backfill(user_id, followed_id):
+    """Copy the recent messages of `followed_id` into `user_id`'s timeline.
+
+    Nothing to copy for a pulled author; read() merges their messages in.
+    The follower count is read from the database, not the session, so the
+    follow being made (counted with an UPDATE) is taken into account.
+    """
+
+    followers_count = (db.session
+                       .query(User.followers_count)
+                       .filter(User.id == followed_id)
+                       .scalar())
+    if followers_count >= pull_threshold():
+        return
+
+    entries = TimelineEntry.__table__
+
+    recent = (select([literal(user_id), Message.id, Message.timestamp])
+              .where(Message.user_id == followed_id)
+              .where(_not_in_timeline(user_id))
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(timeline_length()))
+
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], recent))
+    trim(user_id)
+
+
+def prune(user_id, unfollowed_id):
+    """Remove every message by `unfollowed_id` from `user_id`'s timeline."""
+
+    authored = select([Message.id]).where(Message.user_id == unfollowed_id)
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.message_id.in_(authored))
+     .delete(synchronize_session=False))
+
+
+# Deletes a batch of timeline entries given as parallel arrays of keys,
+# each by primary key
+DELETE_ENTRIES = text("""
+DELETE FROM timeline_entries
+USING unnest(CAST(:user_ids AS integer[]), CAST(:message_ids AS integer[]))
+      AS doomed (user_id, message_id)
+WHERE timeline_entries.user_id = doomed.user_id
+  AND timeline_entries.message_id = doomed.message_id
+""")
+
+
+def trim(*user_ids):
+    """Drop entries that have fallen off the end of these users' timelines.
+
+    Each user's overflow is found by reading their index range newest
+    first, past TIMELINE_LENGTH entries (through a LATERAL join on
+    Postgres, one query per user elsewhere). Only those rows are then
+    deleted, by primary key.
+    """
+
+    entries = TimelineEntry.__table__
+    kept = entries.alias('kept')
+
+    def overflow(user_id):
+        return (select([kept.c.user_id, kept.c.message_id])
+                .where(kept.c.user_id == user_id)
+                .order_by(kept.c.timestamp.desc(), kept.c.message_id.desc())
+                .offset(timeline_length()))
+
+    if db.session.get_bind(TimelineEntry.__mapper__).dialect.name != 'postgresql':
+        for user_id in user_ids:
+            doomed = [tuple(row) for row in db.session.execute(overflow(user_id))]
+            if doomed:
+                db.session.execute(entries.delete().where(
+                    tuple_(entries.c.user_id, entries.c.message_id).in_(doomed)))
+        return
+
+    users = User.__table__
+    dropped = overflow(users.c.id).correlate(users).lateral('dropped')
+    doomed = db.session.execute(
+        select([dropped.c.user_id, dropped.c.message_id])
+        .select_from(users.join(dropped, true()))
+        .where(users.c.id.in_(user_ids))).fetchall()
+
+    if doomed:
+        db.session.execute(DELETE_ENTRIES, dict(
+            user_ids=[user_id for user_id, _ in doomed],
+            message_ids=[message_id for _, message_id in doomed]))
+
+
+def rebuild(user_id):
+    """Recompute `user_id`'s timeline from scratch with the pull query."""
+
+    entries = TimelineEntry.__table__
+
+    followed = (select([Follows.user_being_followed_id])
+                .select_from(Follows.__table__.join(
+                    User.__table__, User.id == Follows.user_being_followed_id))
+                .where(Follows.user_following_id == user_id)
+                .where(User.followers_count < pull_threshold()))
+
+    recent = (select([literal(user_id), Message.id, Message.timestamp])
+              .where((Message.user_id == user_id) |
+                     Message.user_id.in_(followed))
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(timeline_length()))
+
+    TimelineEntry.query.filter_by(user_id=user_id).delete()
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], recent))
+
+
+def pull(user_id, before=None, limit=pagination.DEFAULT_PAGE_SIZE):
+    """Return a page of `user_id`'s home timeline without a precomputed one.
+
+    On Postgres each author (the user and everyone they follow) is read
+    with its own top-N scan of ix_messages_user_timestamp, through a
+    LATERAL join, so the page costs the same however many messages the
+    authors have. Elsewhere it falls back to a plain OR/IN query.
+    """
+
+    query = Message.query.options(db.joinedload(Message.user))
+
+    if db.session.get_bind(Message.__mapper__).dialect.name != 'postgresql':
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+        query = query.filter((Message.user_id == user_id) |
+                             Message.user_id.in_(followed))
+
+    else:
+        authors = (select([literal(user_id).label('author_id')])
+                   .union(select([Follows.user_being_followed_id])
+                          .where(Follows.user_following_id == user_id))
+                   .alias('authors'))
+
+        messages = Message.__table__.alias('authored')
+        newest = (select([messages.c.id])
+                  .where(messages.c.user_id == authors.c.author_id)
+                  .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+                  .limit(limit + 1)
+                  .correlate(authors))
+        if before:
+            newest = newest.where(tuple_(messages.c.timestamp, messages.c.id) <
+                                  tuple_(*before))
+        newest = newest.lateral('newest')
+
+        query = (query
+                 .select_from(authors)
+                 .join(newest, true())
+                 .join(Message, Message.id == newest.c.id))
+
+    return pagination.paginate(query,
+                               Message.timestamp,
+                               Message.id,
+                               before=before,
+                               limit=limit)
+
+
+def read(user_id, before=None, limit=pagination.DEFAULT_PAGE_SIZE):
+    """Return a page of `user_id`'s timeline, newest first.
+
+    The page is a k-way merge of the precomputed entries and a stream per
+    pulled author `user_id` follows, each fetched a page long.
+    """
+
+    pushed = pagination.paginate(
+        Message
+        .query
+        .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+        .options(db.joinedload(Message.user))
+        .filter(TimelineEntry.user_id == user_id),
+        TimelineEntry.timestamp,
+        TimelineEntry.message_id,
+        before=before,
+        limit=limit)
+
+    authors = pulled_authors(user_id)
+    if not authors:
+        return pushed
+
+    start = time.perf_counter()
+
+    streams = [pushed] + [
+        pagination.paginate(Message
+                            .query
+                            .options(db.joinedload(Message.user))
+                            .filter(Message.user_id == author_id),
+                            Message.timestamp,
+                            Message.id,
+                            before=before,
+                            limit=limit)
+        for author_id in authors]
+
+    merged = heapq.merge(*[stream.items for stream in streams],
+                         key=lambda msg: (msg.timestamp, msg.id),
+                         reverse=True)
+
+    # An author who has crossed the threshold can still have pushed copies
+    # of their older messages, which sort right next to the pulled ones.
+    def distinct(messages):
+        last_id = None
+        for msg in messages:
+            if msg.id != last_id:
+                yield msg
+            last_id = msg.id
+
+    items = list(islice(distinct(merged), limit + 1))
+
+    # A stream with more to come means the merged timeline has more too
+    next_cursor = None
+    if len(items) > limit or any(stream.next_cursor for stream in streams):
+        items = items[:limit]
+        next_cursor = pagination.encode_cursor(items[-1].timestamp, items[-1].id)
+
+    merge_stats.record(streams=len(streams),
+                       rows=sum(len(stream.items) for stream in streams),
+                       seconds=time.perf_counter() - start)
+
+    return pagination.Page(items, next_cursor)
@@ -0,0 +1,89 @@
+"""Cache of logged-in users' rows, so most requests skip loading g.user.
+
+The cache holds a plain dict of each user's display and counter columns
+(never their email or password hash). On a hit the dict is turned back
+into a `User` and merged into the session without a query; the columns
+left out load from the database if anything reads them, and
+relationships and writes on g.user keep working as usual.
+
+Routes that change a user's row (profile edits, counters) must call
+`invalidate()`; entries also expire after `USER_CACHE_TTL` seconds, which
+bounds how stale another user's counter changes can make them. An
+in-process cache can't be invalidated from another process (such as the
+job worker deleting an account), so requests that write load the user
+with `fresh=True`, which always checks the database.
+"""
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from cache import make_cache
+from models import db, User
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 60
+
+# The columns worth caching: what pages show of the logged-in user
+CACHED_COLUMNS = ['id', 'username', 'image_url', 'header_image_url', 'bio',
+                  'location', 'messages_count', 'following_count',
+                  'followers_count', 'likes_count', 'version', 'deleting']
+
+cache = None
+
+
+def init_app(app):
+    """Create the cache described by the app's config.
+
+    A USER_CACHE_TTL of 0 turns caching off.
+    """
+
+    global cache
+
+    ttl = app.config.get('USER_CACHE_TTL', DEFAULT_TTL)
+    size = app.config.get('USER_CACHE_SIZE', DEFAULT_SIZE)
+
+    cache = make_cache(app, 'user', max_size=size, ttl=ttl) if ttl else None
+
+
+def _snapshot(user):
+    """The cacheable column values of `user`."""
+
+    return {key: getattr(user, key) for key in CACHED_COLUMNS}
+
+
+def load(user_id, fresh=False):
+    """Return the `User` with `user_id`, from the cache when possible.
+
+    With `fresh`, the user is always read from the database (and the
+    cache updated), so a user deleted elsewhere is never returned.
+    """
+
+    if cache is None:
+        return User.query.get(user_id)
+
+    snapshot = None if fresh else cache.get(user_id)
+
+    if snapshot is None:
+        user = User.query.get(user_id)
+        if user is not None:
+            cache.set(user_id, _snapshot(user))
+        else:
+            cache.delete(user_id)
+        return user
+
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate(*user_ids):
+    """Drop the cached rows of `user_ids` after they have changed."""
+
+    if cache is not None:
+        cache.delete(*user_ids)
+
+
+def clear():
+    """Drop every cached user."""
+
+    if cache is not None:
+        cache.clear()